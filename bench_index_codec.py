@@ -0,0 +1,106 @@
+"""
+	Benchmark kodeka indeksów na wyeksportowanych plikach TMF/SMF
+	(wersje 2 i 3). Dla każdego pliku wypisuje bity na trójkąt i prędkość
+	dekodowania (MB/s zdekodowanych 32-bitowych indeksów), dla kolejności
+	wierzchołków z pliku i po przenumerowaniu w kolejności pierwszego użycia.
+
+	python bench_index_codec.py plik.tmf [plik.smf ...]
+
+	Nie potrzebuje blendera (korzysta tylko z habanero_formats.py).
+"""
+
+import os
+import sys
+import time
+
+from struct import unpack_from
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from habanero_formats import meshFlagBatched, meshFlagIndexCodec, decodeIndexBuffer, encodeIndexBuffer
+
+def readIndices(filename):
+	"""
+		Zwraca listę list indeksów (po jednej na sub-mesh).
+	"""
+	file = open(filename, "rb")
+	data = file.read()
+	file.close()
+	magic = data[0:3]
+	version = data[3:4]
+	offset = 4
+	if magic == b"SMF":
+		offset += 4 # id szkieletu
+	flags = 0
+	if version == b"2":
+		vertex_count, sub_mesh_count = unpack_from('II', data, offset)
+		offset += 8 + vertex_count * (64 if magic == b"SMF" else 32)
+	else:
+		flags, vertex_count, sub_mesh_count, stream_count = unpack_from('IIII', data, offset)
+		offset += 16
+		components = 0
+		for i in range(stream_count):
+			components += unpack_from('BBBB', data, offset)[2]
+			offset += 4
+		offset += vertex_count * components * 4
+	sub_meshes = []
+	for i in range(sub_mesh_count):
+		if flags & meshFlagBatched:
+			offset += 8 + 25 # zakres wierzchołków i AABB batcha
+		if flags & meshFlagIndexCodec:
+			material, index_count, size = unpack_from('III', data, offset)
+			offset += 12
+			sub_meshes.append(decodeIndexBuffer(data[offset:offset + size], index_count))
+			offset += size + (-size % 4)
+		else:
+			material, index_count = unpack_from('II', data, offset)
+			offset += 8
+			sub_meshes.append(list(unpack_from('%dI' % index_count, data, offset)))
+			offset += index_count * 4
+	return sub_meshes
+
+def remapFirstUse(sub_meshes):
+	remap = {}
+	result = []
+	for indices in sub_meshes:
+		for index in indices:
+			if index not in remap:
+				remap[index] = len(remap)
+		result.append([remap[index] for index in indices])
+	return result
+
+def canonical(indices):
+	"""Trójkąty z obróconą kolejnością wierzchołków (kodek może je obracać)."""
+	triangles = []
+	for t in range(0, len(indices) - 2, 3):
+		triangle = list(indices[t:t + 3])
+		# najmniejszy obrót, a nie obrót od najmniejszego indeksu - ten jest
+		# niejednoznaczny dla zdegenerowanych trójkątów (np. 0 1 0 i 1 0 0)
+		triangles.append(min(tuple(triangle[r:] + triangle[:r]) for r in range(3)))
+	return triangles
+
+def benchmark(name, sub_meshes, repeat = 5):
+	triangles = 0
+	encoded_size = 0
+	decode_time = 0.
+	for indices in sub_meshes:
+		encoded = encodeIndexBuffer(indices)
+		start = time.time()
+		for i in range(repeat):
+			decoded = decodeIndexBuffer(encoded, len(indices))
+		decode_time += (time.time() - start) / repeat
+		if canonical(decoded) != canonical(indices):
+			print("%s: decoded indices differ!" % name)
+		triangles += len(indices) // 3
+		encoded_size += len(encoded)
+	if triangles == 0:
+		print("%s: no triangles" % name)
+		return
+	print("%s: %d triangles, %.2f bits/triangle, decode %.1f MB/s" %
+		  (name, triangles, 8. * encoded_size / triangles,
+		   triangles * 12 / max(decode_time, 1e-9) / (1 << 20)))
+
+n = sys.argv.index("--") if "--" in sys.argv else 0
+for filename in sys.argv[n + 1:]:
+	sub_meshes = readIndices(filename)
+	benchmark(filename, sub_meshes)
+	benchmark(filename + " (first use order)", remapFirstUse(sub_meshes))
\ No newline at end of file
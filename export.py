@@ -4,13 +4,23 @@ import bpy
 import sys
 
 n = sys.argv.index("--")
+flags = sys.argv[n + 2:]
 
-if len(sys.argv) > n + 2:
-	tmf = sys.argv[n + 2] == "-s" or sys.argv[n + 2] == "-tmf"
-else:
-	tmf = False
+tmf = "-s" in flags or "-tmf" in flags
+streams = "-streams" in flags
+tangents = "-tangents" in flags
+compress = "-compress" in flags
+workers = 0
+if "-workers" in flags:
+	workers = int(flags[flags.index("-workers") + 1])
+binary_i2n = "-binaryi2n" in flags
+batch = 0.
+if "-batch" in flags:
+	batch = float(flags[flags.index("-batch") + 1])
 
 if len(sys.argv) > n + 1:
-	bpy.ops.export_mesh.hab(filepath=sys.argv[n + 1], saveToTMF=tmf)
+	bpy.ops.export_mesh.hab(filepath=sys.argv[n + 1], saveToTMF=tmf, vertexStreams=streams, exportTangents=tangents,
+		compressIndices=compress, animationWorkers=workers, batchCellSize=batch,
+		binaryNameIndex=binary_i2n)
 else:
 	print("Specify output file.")
\ No newline at end of file
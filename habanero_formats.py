@@ -0,0 +1,420 @@
+"""
+	Formaty plików wspólne dla eksportera (io_export_habanero.py) i konwertera
+	obj2tmf.py: materiały MTF, manifest z crc32, i2n tekstowe i binarne, kodek
+	indeksów TMF/SMF. Bez importu bpy, więc działa też poza blenderem (np.
+	w bench_index_codec.py); w blenderze musi leżeć obok io_export_habanero.py.
+"""
+
+import os
+import zlib
+
+from struct import pack, unpack_from
+
+class Color:
+	def __init__(self, array = None):
+		self.r = 0.
+		self.g = 0.
+		self.b = 0.
+		self.a = 0.
+		if array:
+			self.set_color(array)
+
+	def set_color(self, array):
+		if len(array) == 3: #jako, że kolory w blenderze nie mają alpha
+			self.r = array[0]
+			self.g = array[1]
+			self.b = array[2]
+			self.a = 1.
+
+	def dump(self):
+		data = pack('ffff', self.r, self.g, self.b, self.a)
+		return data
+
+def dumpMaterial(values):
+	"""
+		Dane materiału w MTF (bez nagłówka): flagi, kolory albo numery
+		tekstur w slotach 0-3, przezroczystość i numery pozostałych tekstur.
+		values jak w Material.values eksportera.
+	"""
+	flags = 0
+	counter = 0
+	for val in values:
+		if counter == 3 or counter > 4:
+			flags += (val is not None) << counter
+		else:
+			flags += (not isinstance(val, int)) << counter
+		counter += 1
+	data = pack("I", flags)
+	for i in range(4):
+		if isinstance(values[i], int):
+			data += pack("I", values[i])
+		else:
+			data += values[i].dump()
+	if isinstance(values[4], int):
+		data += pack("I", values[4])
+	else:
+		data += pack("f", values[4])
+	for i in range(5, 8):
+		if values[i] is not None:
+			data += pack("I", values[i])
+	return data
+
+def replaceFile(source, destination):
+	if hasattr(os, "replace"):
+		os.replace(source, destination)
+	else: # starsze pythony nie mają os.replace, a na Windowsie rename nie nadpisuje
+		if os.path.exists(destination):
+			os.remove(destination)
+		os.rename(source, destination)
+
+def readManifest(manifest_path):
+	"""
+		Manifest to plik tekstowy, w każdej linii: crc32 (hex), rozmiar, nazwa pliku
+		(względem katalogu manifestu).
+	"""
+	entries = {}
+	file = open(manifest_path, "r")
+	for line in file:
+		fields = line.rstrip("\n").split(" ", 2)
+		if len(fields) == 3:
+			entries[fields[2]] = (int(fields[0], 16), int(fields[1]))
+	file.close()
+	return entries
+
+def dumpManifest(entries):
+	"""
+		entries: nazwa pliku -> (crc32, rozmiar); format jak w readManifest.
+	"""
+	lines = ["%08x %d %s\n" % (entries[name][0], entries[name][1], name) for name in sorted(entries)]
+	return "".join(lines).encode("utf-8")
+
+def fileChecksum(filename):
+	crc = 0
+	file = open(filename, "rb")
+	while True:
+		chunk = file.read(1 << 20)
+		if not chunk:
+			break
+		crc = zlib.crc32(chunk, crc)
+	file.close()
+	return crc & 0xFFFFFFFF
+
+def verifyManifest(manifest_path):
+	"""
+		Sprawdza pliki wymienione w manifeście. Najpierw tanio porównuje
+		rozmiary, crc32 liczy tylko dla plików o poprawnym rozmiarze.
+		Zwraca listę nazw plików, które się nie zgadzają (pusta, gdy wszystko OK).
+	"""
+	directory = os.path.dirname(manifest_path)
+	bad = []
+	for name, (crc, size) in sorted(readManifest(manifest_path).items()):
+		filename = os.path.join(directory, name)
+		if not os.path.isfile(filename) or os.path.getsize(filename) != size:
+			bad.append(name)
+		elif fileChecksum(filename) != crc:
+			bad.append(name)
+	return bad
+
+# Binarne i2n. Wszystko little-endian, offsety liczone od początku pliku,
+# więc plik można zmapować do pamięci i używać bez parsowania.
+# Nagłówek (24 bajty): 'I2NB', wersja, liczba sekcji, offset i rozmiar
+# tablicy napisów, zarezerwowane.
+# Sekcja (24 bajty): id sekcji, liczba wpisów, offset wpisów, rozmiar
+# tablicy indeksów, offset tablicy indeksów, zarezerwowane.
+# Wpis (16 bajtów, posortowane po haszu): uint64 hasz FNV-1a nazwy,
+# uint32 indeks, uint32 offset nazwy w tablicy napisów.
+# Tablica indeksów: dla każdego indeksu offset nazwy (0xFFFFFFFF - brak).
+# Tablica napisów: nazwy w UTF-8 zakończone zerem.
+i2nSectionIds = {"materials": 0, "textures": 1, "skeleton": 2, "joints": 3, "animations": 4}
+i2nNoName = 0xFFFFFFFF
+
+def nameHash(name):
+	"""
+		64-bitowy FNV-1a z nazwy w UTF-8.
+	"""
+	value = 0xcbf29ce484222325
+	for byte in bytearray(name.encode("utf-8")):
+		value = ((value ^ byte) * 0x100000001b3) & 0xFFFFFFFFFFFFFFFF
+	return value
+
+def dumpBinaryI2n(sections):
+	strings = bytearray()
+	string_offsets = {}
+	layout = []
+	offset = 24 + 24 * len(sections)
+	for section_name, entries in sections:
+		hashed = []
+		for index, name in entries:
+			if name not in string_offsets:
+				string_offsets[name] = len(strings)
+				strings += name.encode("utf-8") + b"\0"
+			hashed.append((nameHash(name), index, string_offsets[name]))
+		hashed.sort()
+		by_index = [i2nNoName] * (max([index for index, name in entries] + [-1]) + 1)
+		for index, name in entries:
+			by_index[index] = string_offsets[name]
+		entries_offset = offset
+		by_index_offset = entries_offset + 16 * len(hashed)
+		offset = by_index_offset + 4 * len(by_index)
+		offset += -offset % 8
+		layout.append((i2nSectionIds[section_name], hashed, entries_offset, by_index, by_index_offset))
+	data = pack('<BBBBIIIII', ord('I'), ord('2'), ord('N'), ord('B'), 1, len(sections), offset, len(strings), 0)
+	for section_id, hashed, entries_offset, by_index, by_index_offset in layout:
+		data += pack('<IIIIII', section_id, len(hashed), entries_offset, len(by_index), by_index_offset, 0)
+	for section_id, hashed, entries_offset, by_index, by_index_offset in layout:
+		for entry in hashed:
+			data += pack('<QII', *entry)
+		data += pack('<%dI' % len(by_index), *by_index)
+		data += pack('<%dx' % (-len(data) % 8))
+	return data + bytes(strings)
+
+def binaryI2nSection(data, section_name):
+	section_id = i2nSectionIds[section_name]
+	section_count, strings_offset = unpack_from('<II', data, 8)
+	for i in range(section_count):
+		section = unpack_from('<IIIIII', data, 24 + 24 * i)
+		if section[0] == section_id:
+			return section, strings_offset
+	return None, strings_offset
+
+def binaryI2nString(data, strings_offset, name_offset):
+	start = strings_offset + name_offset
+	return bytes(data[start:data.find(b"\0", start)]).decode("utf-8")
+
+def lookupBinaryI2n(data, section_name, name):
+	"""
+		Indeks nazwy w sekcji binarnego i2n (wyszukiwanie binarne po haszu),
+		None gdy jej nie ma. data może być np. obiektem mmap.
+	"""
+	section, strings_offset = binaryI2nSection(data, section_name)
+	if section is None:
+		return None
+	section_id, count, entries_offset = section[:3]
+	key = nameHash(name)
+	low = 0
+	high = count
+	while low < high:
+		middle = (low + high) // 2
+		if unpack_from('<Q', data, entries_offset + 16 * middle)[0] < key:
+			low = middle + 1
+		else:
+			high = middle
+	while low < count: # przy kolizji haszy porównujemy nazwy
+		value, index, name_offset = unpack_from('<QII', data, entries_offset + 16 * low)
+		if value != key:
+			break
+		if binaryI2nString(data, strings_offset, name_offset) == name:
+			return index
+		low += 1
+	return None
+
+def nameFromBinaryI2n(data, section_name, index):
+	section, strings_offset = binaryI2nSection(data, section_name)
+	if section is None or index >= section[3]:
+		return None
+	name_offset = unpack_from('<I', data, section[4] + 4 * index)[0]
+	if name_offset == i2nNoName:
+		return None
+	return binaryI2nString(data, strings_offset, name_offset)
+
+def dumpTextI2n(sections):
+	"""
+		Tekstowe i2n: dla każdej sekcji "#nazwa", potem linie "indeks. nazwa".
+	"""
+	lines = []
+	for section_name, entries in sections:
+		lines.append("#%s\n" % section_name)
+		for index, name in entries:
+			lines.append("%d. %s\n" % (index, name))
+	return "".join(lines).encode("utf-8")
+
+# Flagi nagłówka TMF/SMF w wersji 3
+meshFlagIndexCodec = 1 # indeksy zakodowane encodeIndexBuffer
+meshFlagBatched = 2 # sub-meshe to MeshBatch z zakresem wierzchołków i AABB
+
+# Kodek bufora indeksów (w stylu kodeka z meshoptimizera).
+# Dla każdego trójkąta jeden bajt kodu, do tego osobny strumień varintów
+# z jawnie zapisanymi indeksami (zigzag delta od ostatniego jawnego).
+# Kod: górne 4 bity to pozycja krawędzi w kolejce krawędzi (15 = brak),
+# dolne 4 bity mówią, skąd wziąć pozostałe wierzchołki:
+# - przy znalezionej krawędzi: 0 = kolejny nowy wierzchołek (next),
+#   1..14 = pozycja w kolejce wierzchołków, 15 = indeks jawny,
+# - bez krawędzi: bit i ustawiony = i-ty wierzchołek to next, inaczej jawny.
+codecFifoSize = 16
+codecNoEdge = 15
+codecExplicit = 15
+codecNext = -1
+codecExplicitVertex = -2
+
+def buildCodecTable():
+	"""
+		Tablica dekodera: dla każdego bajtu kodu (pozycja krawędzi, źródła
+		wierzchołków). Źródło to codecNext, codecExplicitVertex albo
+		pozycja w kolejce wierzchołków.
+	"""
+	table = []
+	for code in range(256):
+		edge = code >> 4
+		low = code & 15
+		if edge != codecNoEdge:
+			if low == 0:
+				sources = (codecNext,)
+			elif low == codecExplicit:
+				sources = (codecExplicitVertex,)
+			else:
+				sources = (low - 1,)
+		else:
+			sources = tuple(codecNext if low & (1 << i) else codecExplicitVertex for i in range(3))
+		table.append((edge, sources))
+	return table
+
+codecTable = buildCodecTable()
+
+def encodeVarint(data, value):
+	value = value * 2 if value >= 0 else -value * 2 - 1 # zigzag
+	while value >= 0x80:
+		data.append((value & 0x7F) | 0x80)
+		value >>= 7
+	data.append(value)
+
+def encodeIndexBuffer(indices):
+	"""
+		Koduje listę trójkątów (indeksy po 3). Zwraca bytes: kody
+		(po jednym na trójkąt), a po nich strumień varintów.
+	"""
+	codes = bytearray()
+	data = bytearray()
+	edge_fifo = [(-1, -1)] * codecFifoSize
+	edge_offset = 0
+	vertex_fifo = [-1] * codecFifoSize
+	vertex_offset = 0
+	next = 0
+	last = 0
+	for t in range(0, len(indices) - 2, 3):
+		triangle = indices[t:t + 3]
+		found = None
+		for rotation in range(3):
+			a = triangle[rotation]
+			b = triangle[(rotation + 1) % 3]
+			c = triangle[(rotation + 2) % 3]
+			for i in range(codecFifoSize - 1):
+				if edge_fifo[(edge_offset - 1 - i) % codecFifoSize] == (a, b):
+					found = (i, a, b, c)
+					break
+			if found:
+				break
+		if found:
+			fe, a, b, c = found
+			if c == next:
+				low = 0
+				next += 1
+				vertex_fifo[vertex_offset] = c
+				vertex_offset = (vertex_offset + 1) % codecFifoSize
+			else:
+				low = codecExplicit
+				for k in range(codecExplicit - 1):
+					if vertex_fifo[(vertex_offset - 1 - k) % codecFifoSize] == c:
+						low = k + 1
+						break
+				if low == codecExplicit:
+					encodeVarint(data, c - last)
+					last = c
+					vertex_fifo[vertex_offset] = c
+					vertex_offset = (vertex_offset + 1) % codecFifoSize
+			codes.append((fe << 4) | low)
+			new_edges = ((c, b), (a, c))
+		else:
+			a, b, c = triangle
+			low = 0
+			for i, vertex in enumerate(triangle):
+				if vertex == next:
+					low |= 1 << i
+					next += 1
+				else:
+					encodeVarint(data, vertex - last)
+					last = vertex
+				vertex_fifo[vertex_offset] = vertex
+				vertex_offset = (vertex_offset + 1) % codecFifoSize
+			codes.append((codecNoEdge << 4) | low)
+			new_edges = ((b, a), (c, b), (a, c))
+		for edge in new_edges:
+			edge_fifo[edge_offset] = edge
+			edge_offset = (edge_offset + 1) % codecFifoSize
+	return bytes(codes + data)
+
+def decodeIndexBuffer(encoded, index_count):
+	"""
+		Odwrotność encodeIndexBuffer, sterowana tablicą codecTable.
+	"""
+	triangle_count = index_count // 3
+	codes = encoded[:triangle_count]
+	position = triangle_count
+	indices = [0] * index_count
+	edge_fifo = [(-1, -1)] * codecFifoSize
+	edge_offset = 0
+	vertex_fifo = [-1] * codecFifoSize
+	vertex_offset = 0
+	next = 0
+	last = 0
+	out = 0
+	table = codecTable
+	for code in codes:
+		edge, sources = table[code]
+		if edge != codecNoEdge:
+			a, b = edge_fifo[(edge_offset - 1 - edge) % codecFifoSize]
+			source = sources[0]
+			if source == codecNext:
+				c = next
+				next += 1
+				vertex_fifo[vertex_offset] = c
+				vertex_offset = (vertex_offset + 1) % codecFifoSize
+			elif source == codecExplicitVertex:
+				value = 0
+				shift = 0
+				while True:
+					byte = encoded[position]
+					position += 1
+					value |= (byte & 0x7F) << shift
+					shift += 7
+					if byte < 0x80:
+						break
+				c = last + ((value >> 1) ^ -(value & 1))
+				last = c
+				vertex_fifo[vertex_offset] = c
+				vertex_offset = (vertex_offset + 1) % codecFifoSize
+			else:
+				c = vertex_fifo[(vertex_offset - 1 - source) % codecFifoSize]
+			edge_fifo[edge_offset] = (c, b)
+			edge_fifo[(edge_offset + 1) % codecFifoSize] = (a, c)
+			edge_offset = (edge_offset + 2) % codecFifoSize
+		else:
+			triangle = []
+			for source in sources:
+				if source == codecNext:
+					vertex = next
+					next += 1
+				else:
+					value = 0
+					shift = 0
+					while True:
+						byte = encoded[position]
+						position += 1
+						value |= (byte & 0x7F) << shift
+						shift += 7
+						if byte < 0x80:
+							break
+					vertex = last + ((value >> 1) ^ -(value & 1))
+					last = vertex
+				vertex_fifo[vertex_offset] = vertex
+				vertex_offset = (vertex_offset + 1) % codecFifoSize
+				triangle.append(vertex)
+			a, b, c = triangle
+			edge_fifo[edge_offset] = (b, a)
+			edge_fifo[(edge_offset + 1) % codecFifoSize] = (c, b)
+			edge_fifo[(edge_offset + 2) % codecFifoSize] = (a, c)
+			edge_offset = (edge_offset + 3) % codecFifoSize
+		indices[out] = a
+		indices[out + 1] = b
+		indices[out + 2] = c
+		out += 3
+	return indices
\ No newline at end of file
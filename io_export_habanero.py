@@ -1,8 +1,21 @@
 import bpy
+from bpy.app.handlers import persistent
+from mathutils import Matrix, Vector
 from operator import attrgetter
+import copy
+import json
+import math
 import os
+import shutil
+import subprocess
+import tempfile
+import zlib
 
-from struct import pack
+from concurrent.futures import ThreadPoolExecutor
+from struct import pack, unpack_from
+
+from habanero_formats import replaceFile, readManifest, dumpManifest, dumpBinaryI2n, \
+	dumpTextI2n, Color, dumpMaterial, meshFlagIndexCodec, meshFlagBatched, encodeIndexBuffer
 
 bl_info = {
     "name": "Habanero exporter (.saf and .smf)",
@@ -17,6 +30,7 @@ bl_info = {
 	
 exportMessage = "Finished"
 maxStrLen = 32
+animationBoundsMargin = 0.1 # o tyle przekątnej powiększamy AABB animacji na ruch pomiędzy klatkami kluczowymi
 
 def equal(a, b):
 	return abs(a - b) < 1e-6
@@ -133,27 +147,10 @@ class Vector2f:
 		data = pack('ff', self.x, self.y)
 		return data
 
-class Color:
-	def __init__(self, array = None):
-		self.r = 0.
-		self.g = 0.
-		self.b = 0.
-		self.a = 0.
-		if array:
-			self.set_color(array)
-
-	def set_color(self, array):
-		if len(array) == 3: #jako, że kolory w blenderze nie mają alpha
-			self.r = array[0]
-			self.g = array[1]
-			self.b = array[2]
-			self.a = 1.
-
-	def dump(self):
-		data = pack('ffff', self.r, self.g, self.b, self.a)
-		return data
-
 class SkinnedMesh:
+	INDEX_CODEC = meshFlagIndexCodec # flaga wersji 3: indeksy zakodowane encodeIndexBuffer
+	BATCHED = meshFlagBatched # flaga wersji 3: sub-meshe to MeshBatch z zakresem wierzchołków i AABB
+
 	def __init__(self):
 		self.vertices = DumpableList()
 		self.sub_meshes = DumpableList()
@@ -168,6 +165,157 @@ class SkinnedMesh:
 		data = pack('II', len(self.vertices), len(self.sub_meshes)) + self.vertices.dump_tmf() + self.sub_meshes.dump()
 		return data
 
+	def dump_streams(self, vertex_format, flags = 0):
+		"""
+			Wersja 3 formatu: zamiast przeplatanych wierzchołków zapisujemy
+			deskryptor formatu i każdy strumień jako osobny, ciągły bufor.
+			Z flagą INDEX_CODEC indeksy sub-meshy są skompresowane.
+		"""
+		print("Packing %d vertices in %d streams, %d submeshes" %
+			  (len(self.vertices), len(vertex_format.streams), len(self.sub_meshes)))
+		data = pack('III', flags, len(self.vertices), len(self.sub_meshes)) + \
+			   vertex_format.dump(self.vertices)
+		if flags & SkinnedMesh.INDEX_CODEC:
+			for sub_mesh in self.sub_meshes:
+				data += sub_mesh.dump_compressed()
+		else:
+			data += self.sub_meshes.dump()
+		return data
+
+	def optimize_vertex_fetch(self):
+		"""
+			Numeruje wierzchołki w kolejności pierwszego użycia przez trójkąty,
+			dzięki temu kodek indeksów częściej trafia w "next".
+		"""
+		order = DumpableList()
+		used = set() # po id(), bo SkinVertex4 porównuje wartości
+		for sub_mesh in self.sub_meshes:
+			for vertex in sub_mesh.vertices:
+				if id(vertex) not in used:
+					used.add(id(vertex))
+					order.append(vertex)
+		for vertex in self.vertices:
+			if id(vertex) not in used:
+				order.append(vertex)
+		self.vertices = order
+
+class VertexStream:
+	"""
+		Opis jednego strumienia atrybutów wierzchołka. Getter zwraca
+		krotkę components wartości dla danego wierzchołka.
+	"""
+	POSITION = 0
+	NORMAL = 1
+	TANGENT = 2
+	TEXCOORD = 3
+	COLOR = 4
+	JOINTS = 5
+	WEIGHTS = 6
+
+	FLOAT = 0
+	UINT = 1
+
+	def __init__(self, semantic, index, components, component_type, getter):
+		self.semantic = semantic
+		self.index = index
+		self.components = components
+		self.component_type = component_type
+		self.getter = getter
+
+	def dump_descriptor(self):
+		return pack('BBBB', self.semantic, self.index, self.components, self.component_type)
+
+	def dump(self, vertices):
+		values = []
+		for vertex in vertices:
+			values.extend(self.getter(vertex))
+		if self.component_type == VertexStream.FLOAT:
+			return pack('%df' % len(values), *values)
+		return pack('%dI' % len(values), *values)
+
+class VertexFormat:
+	"""
+		Deskryptor formatu wierzchołka: lista strumieni zapisywana przed
+		buforami. Po deskryptorze idą bufory w tej samej kolejności, każdy
+		ma len(vertices) * components * 4 bajtów.
+	"""
+	def __init__(self):
+		self.streams = []
+
+	def add(self, semantic, index, components, component_type, getter):
+		self.streams.append(VertexStream(semantic, index, components, component_type, getter))
+
+	def dump(self, vertices):
+		data = pack('I', len(self.streams))
+		for stream in self.streams:
+			data += stream.dump_descriptor()
+		for stream in self.streams:
+			data += stream.dump(vertices)
+		return data
+
+def uvGetter(index):
+	def getter(vertex):
+		if index < len(vertex.tex_coords):
+			return (vertex.tex_coords[index].x, vertex.tex_coords[index].y)
+		return (0., 0.)
+	return getter
+
+def colorGetter(index):
+	def getter(vertex):
+		if index < len(vertex.colors):
+			color = vertex.colors[index]
+			return (color.r, color.g, color.b, color.a)
+		return (1., 1., 1., 1.)
+	return getter
+
+def createVertexFormat(mesh, skinned, options):
+	"""
+		Strumienie: pozycja, normalna, opcjonalnie tangent, uv0..N, kolory,
+		a dla SMF jeszcze indeksy jointów i wagi. Obiekty mogą mieć różną
+		liczbę warstw, brakujące uzupełniamy wartościami domyślnymi.
+	"""
+	vertex_format = VertexFormat()
+	vertex_format.add(VertexStream.POSITION, 0, 3, VertexStream.FLOAT,
+					  lambda v: (v.position.x, v.position.y, v.position.z))
+	vertex_format.add(VertexStream.NORMAL, 0, 3, VertexStream.FLOAT,
+					  lambda v: (v.normal.x, v.normal.y, v.normal.z))
+	if options.tangents:
+		vertex_format.add(VertexStream.TANGENT, 0, 4, VertexStream.FLOAT,
+						  lambda v: v.tangent)
+	uv_count = max([len(v.tex_coords) for v in mesh.vertices] + [1])
+	for i in range(uv_count):
+		vertex_format.add(VertexStream.TEXCOORD, i, 2, VertexStream.FLOAT, uvGetter(i))
+	color_count = max([len(v.colors) for v in mesh.vertices] + [0])
+	for i in range(color_count):
+		vertex_format.add(VertexStream.COLOR, i, 4, VertexStream.FLOAT, colorGetter(i))
+	if skinned:
+		vertex_format.add(VertexStream.JOINTS, 0, 4, VertexStream.UINT,
+						  lambda v: [joint.id for joint in v.joints[:4]])
+		vertex_format.add(VertexStream.WEIGHTS, 0, 4, VertexStream.FLOAT,
+						  lambda v: v.joint_weights[:4])
+	return vertex_format
+
+class ExportOptions:
+	"""
+		Opcje eksportu przekazywane z operatora do writeFiles.
+	"""
+	def __init__(self):
+		self.vertex_streams = False # SMF3/TMF3 z deskryptorem formatu wierzchołka
+		self.tangents = False # strumień tangentów (wymaga vertex_streams)
+		self.compress_indices = False # kodek indeksów (wymaga vertex_streams)
+		self.animation_workers = 0 # ile procesów blendera próbkuje akcje (0 lub 1 - bez workerów)
+		self.blend_saved = False # czy przed eksportem plik .blend był zapisany (workery czytają go z dysku)
+		self.batch_cell_size = 0. # bok komórki dla batchStaticMesh (0 - bez batchowania, tylko TMF)
+		self.binary_i2n = False # i2n.bin zamiast tekstowego i2n
+
+	def mesh_flags(self):
+		flags = 0
+		if self.compress_indices:
+			flags |= SkinnedMesh.INDEX_CODEC
+		if self.batch_cell_size > 0.:
+			flags |= SkinnedMesh.BATCHED
+		return flags
+
 class Empty():
 	def dump(self):
 		return pack('')
@@ -179,6 +327,10 @@ class SkinVertex4:
 		self.position = Vector3f()
 		self.normal = Vector3f()
 		self.tex_coord = Vector2f()
+		self.tex_coords = [] # wszystkie warstwy UV, tex_coord to pierwsza z nich
+		self.colors = [] # wszystkie warstwy kolorów wierzchołków
+		self.corner_key = None # atrybuty rogu ściany, z którego wzięto UV i kolory
+		self.tangent = (1., 0., 0., 1.) # tangent i znak bitangenta, liczone w computeTangents
 		self.joints = [] # Z początku trzymamy listę jointów (a nie indexów).
 		self.joint_weights = []
 		self.cloned = {}
@@ -301,28 +453,7 @@ class Material:
 			self.values[4] = bl_material.alpha
 
 	def dump(self):
-		flags = 0
-		counter = 0
-		for val in self.values:
-			if counter == 3 or counter > 4:
-				flags += (val is not None) << counter
-			else:
-				flags += (not isinstance(val, int)) << counter
-			counter += 1
-		data = pack("I", flags)
-		for i in range(4):
-			if isinstance(self.values[i], int):
-				data += pack("I", self.values[i])
-			else:
-				data += self.values[i].dump()
-		if isinstance(self.values[4], int):
-			data += pack("I", self.values[4])
-		else:
-			data += pack("f", self.values[4])
-		for i in range(5, 8):
-			if self.values[i] is not None:
-				data += pack("I", self.values[i])
-		return data
+		return dumpMaterial(self.values)
 
 class BoundingVolume:
 	"""
@@ -338,7 +469,9 @@ class BoundingVolume:
 		self.zmax = float("-inf")
 
 	def update(self, vertex):
-		pos = vertex.position
+		self.update_point(vertex.position)
+
+	def update_point(self, pos): # pos może być Vector3f albo mathutils.Vector
 		if pos.x < self.xmin:
 			self.xmin = pos.x
 		if pos.y < self.ymin:
@@ -352,6 +485,20 @@ class BoundingVolume:
 		if pos.z > self.zmax:
 			self.zmax = pos.z
 
+	def merge(self, other):
+		if other.is_empty():
+			return
+		for corner in other.corners():
+			self.update_point(corner)
+
+	def is_empty(self):
+		return self.xmin > self.xmax
+
+	def corners(self):
+		return [Vector((x, y, z)) for x in (self.xmin, self.xmax)
+								  for y in (self.ymin, self.ymax)
+								  for z in (self.zmin, self.zmax)]
+
 	def dump(self):
 		data = pack('B', self.bounding_volume_type) + \
 			   pack('ffffff', self.xmin, self.ymin, self.zmin, self.xmax, self.ymax, self.zmax)
@@ -362,15 +509,106 @@ class SubMesh:
 		self.material = Material(self)
 		self.vertices = []
 
-	def dump(self):
+	def index_list(self):
 		indices = []
 		for vertex in self.vertices:
 			indices.append(vertex.id)
+		return indices
+
+	def dump(self):
+		indices = self.index_list()
 		data = pack('II', self.material.id, len(indices))
 		for index in indices:
 			data += pack('I', index)
 		return data
 
+	def dump_compressed(self):
+		"""
+			Jak dump, ale indeksy zakodowane encodeIndexBuffer: po liczbie
+			indeksów idzie długość danych w bajtach, dane są dopełnione do 4 bajtów.
+		"""
+		indices = self.index_list()
+		encoded = encodeIndexBuffer(indices)
+		print("Submesh %s: %d triangles, %.2f bits/triangle" %
+			  (self.material.name, len(indices) // 3, 8. * len(encoded) / max(len(indices) // 3, 1)))
+		data = pack('III', self.material.id, len(indices), len(encoded)) + encoded
+		return data + pack('%dx' % (-len(encoded) % 4))
+
+class MeshBatch(SubMesh):
+	"""
+		Fragment statycznej geometrii z jednym materiałem w jednej komórce
+		siatki (patrz batchStaticMesh). Ma własny, ciągły zakres wierzchołków
+		i AABB; indeksy są zapisywane względem początku zakresu.
+		Zapis: vertex_offset, vertex_count, AABB, a potem to, co SubMesh.
+	"""
+	def __init__(self, material):
+		self.material = material
+		self.vertices = []
+		self.vertex_offset = 0
+		self.vertex_count = 0
+		self.bounding_volume = BoundingVolume()
+
+	def index_list(self):
+		return [vertex.id - self.vertex_offset for vertex in self.vertices]
+
+	def dump_range(self):
+		return pack('II', self.vertex_offset, self.vertex_count) + self.bounding_volume.dump()
+
+	def dump(self):
+		return self.dump_range() + SubMesh.dump(self)
+
+	def dump_compressed(self):
+		return self.dump_range() + SubMesh.dump_compressed(self)
+
+def batchStaticMesh(mesh, cell_size):
+	"""
+		Dzieli trójkąty każdego sub-mesha według komórki siatki o boku
+		cell_size, do której trafia ich środek. Każda para (materiał, komórka)
+		staje się osobnym MeshBatch. Wierzchołki współdzielone przez kilka
+		batchy są klonowane, żeby każdy miał ciągły zakres.
+	"""
+	batches = {}
+	for index in range(len(mesh.sub_meshes)):
+		sub_mesh = mesh.sub_meshes[index]
+		triangles = sub_mesh.vertices
+		for t in range(0, len(triangles) - 2, 3):
+			corners = triangles[t:t + 3]
+			cell = (int(math.floor((corners[0].position.x + corners[1].position.x + corners[2].position.x) / (3. * cell_size))),
+					int(math.floor((corners[0].position.y + corners[1].position.y + corners[2].position.y) / (3. * cell_size))),
+					int(math.floor((corners[0].position.z + corners[1].position.z + corners[2].position.z) / (3. * cell_size))))
+			key = (index, cell)
+			if key not in batches:
+				batches[key] = MeshBatch(sub_mesh.material)
+			batches[key].vertices.extend(corners)
+
+	vertices = DumpableList()
+	sub_meshes = DumpableList()
+	owned = set() # id() wierzchołków, które już należą do jakiegoś batcha
+	for key in sorted(batches):
+		batch = batches[key]
+		batch.vertex_offset = len(vertices)
+		local = {}
+		triangles = []
+		for vertex in batch.vertices:
+			batch_vertex = local.get(id(vertex))
+			if batch_vertex is None:
+				if id(vertex) in owned:
+					batch_vertex = copy.copy(vertex)
+				else:
+					batch_vertex = vertex
+					owned.add(id(vertex))
+				vertices.append(batch_vertex)
+				batch.bounding_volume.update(batch_vertex)
+				local[id(vertex)] = batch_vertex
+			triangles.append(batch_vertex)
+		batch.vertices = triangles
+		batch.vertex_count = len(vertices) - batch.vertex_offset
+		sub_meshes.append(batch)
+	print("Batched %d submeshes into %d batches (%d vertices, was %d)" %
+		  (len(mesh.sub_meshes), len(sub_meshes), len(vertices), len(mesh.vertices)))
+	mesh.vertices = vertices
+	mesh.sub_meshes = sub_meshes
+
 class RTf:
 	def __init__(self):
 		self.rotation = Quaternionf()
@@ -394,6 +632,8 @@ class SkeletonJoint:
 		self.id = 0
 		self.parent = None # też jest SkeletonJointem
 		self.bind_pose = RTf()
+		self.inverse_bind = RTf() # odwrotność bind pose w przestrzeni modelu
+		self.depth = 0 # 0 dla korzeni
 		self.name = ""
 
 	def dump(self):
@@ -417,6 +657,12 @@ def packString(string):
 	return data
 
 class Skeleton:
+	"""
+		Jointy są posortowane tak, że rodzic jest zawsze przed dziećmi
+		(patrz sortSkeletonJoints). Po jointach idzie tablica głębokości
+		i odwrotności bind pose, żeby paletę skinningu dało się policzyć
+		jednym liniowym przejściem.
+	"""
 	def __init__(self):
 		self.name = ""
 		self.id = 1
@@ -424,17 +670,70 @@ class Skeleton:
 		self.animations = DumpableList()
 
 	def dump(self):
+		depths = [joint.depth for joint in self.joints]
 		data = pack("III", len(self.joints), len(self.animations), self.id) + \
-			   self.joints.dump() + self.animations.dump()
+			   self.joints.dump() + pack("%dI" % len(depths), *depths)
+		for joint in self.joints:
+			data += joint.inverse_bind.dump()
+		data += self.animations.dump()
 		return data
 
+def sortSkeletonJoints(skeleton):
+	"""
+		Przenumerowuje jointy w kolejności przeszukiwania w głąb (rodzic przed
+		dziećmi) i ustawia ich głębokość. Indeksy w wierzchołkach zmieniają się
+		same (trzymamy tam obiekty jointów), sekwencje klatek animacji trzeba
+		przestawić. Animacje armatur wczytanych wcześniej nie mają sekwencji
+		dla kości późniejszych armatur - dostają one stałą pozę spoczynkową.
+	"""
+	children = {}
+	roots = []
+	for joint in skeleton.joints:
+		if joint.parent is None:
+			roots.append(joint)
+		else:
+			children.setdefault(joint.parent.id, []).append(joint)
+	ordered = []
+	stack = [(joint, 0) for joint in reversed(roots)]
+	while stack:
+		joint, depth = stack.pop()
+		joint.depth = depth
+		ordered.append(joint)
+		for child in reversed(children.get(joint.id, [])):
+			stack.append((child, depth + 1))
+	old_ids = [joint.id for joint in ordered]
+	del skeleton.joints[:]
+	for joint in ordered:
+		skeleton.joints.append(joint)
+	for animation in skeleton.animations:
+		sequences = animation.keyframe_sequences
+		while len(sequences) < len(ordered):
+			sequences.append(restSequence(animation))
+		animation.keyframe_sequences = DumpableList()
+		for old_id in old_ids:
+			animation.keyframe_sequences.append(sequences[old_id])
+
+def restSequence(animation):
+	"""
+		Sekwencja jointa bez kości w armaturze animacji: jedna klatka
+		z pozą spoczynkową (tak jak dla kości, której akcja nie rusza).
+	"""
+	sequence = SkeletonJointKeyframeSequence()
+	keyframe = SkeletonJointKeyframe()
+	if len(animation.keyframe_sequences) and len(animation.keyframe_sequences[0].frames):
+		keyframe.beginTime = animation.keyframe_sequences[0].frames[0].beginTime
+	sequence.frames.append(keyframe)
+	return sequence
+
 class SkeletalAnimation:
 	def __init__(self):
 		self.name = ""
 		self.keyframe_sequences = DumpableList()
+		self.bounding_volume = BoundingVolume() # AABB całej animacji (po skinningu)
+		self.skin_matrices = [] # dla każdej klatki kluczowej: nazwa kości -> macierz skinningu
 
 	def dump(self):
-		data = self.keyframe_sequences.dump()
+		data = self.bounding_volume.dump() + self.keyframe_sequences.dump()
 		return data
 
 class SkeletonJointKeyframeSequence:
@@ -518,62 +817,136 @@ def triangulateMesh(object):
 		me_ob = object
 	return triangulated, me_ob
 
-def writeTMFFile(mesh, bv, file_path):
+class OutputSet:
+	"""
+		Zbiór plików wyjściowych zapisywanych razem. Pliki są serializowane
+		i zapisywane równolegle do plików tymczasowych (z fsync), a dopiero
+		gdy wszystkie się udały, przenoszone na miejsce. Na koniec zapisywany
+		jest manifest z crc32 i rozmiarami - jego brak albo niezgodność
+		oznacza niekompletny zestaw.
+	"""
+	workers = 4
+
+	def __init__(self, file_path, keep_entries = False):
+		self.manifest_path = os.path.splitext(file_path)[0] + ".manifest"
+		self.outputs = [] # (nazwa pliku, funkcja zwracająca dane)
+		self.keep_entries = keep_entries # zapis części zestawu: wpisy pozostałych plików zostają w manifeście
+
+	def add(self, filename, dump):
+		self.outputs.append((filename, dump))
+
+	def write_temporary(self, filename, dump):
+		data = dump()
+		temporary = filename + ".tmp"
+		file = open(temporary, "wb")
+		try:
+			file.write(data)
+			file.flush()
+			os.fsync(file.fileno())
+		finally:
+			file.close()
+		return temporary, zlib.crc32(data) & 0xFFFFFFFF, len(data)
+
+	def commit(self):
+		results = []
+		error = None
+		executor = ThreadPoolExecutor(max_workers=self.workers)
+		try:
+			futures = [executor.submit(self.write_temporary, filename, dump) for filename, dump in self.outputs]
+			for (filename, dump), future in zip(self.outputs, futures):
+				try:
+					results.append((filename,) + future.result())
+				except Exception as e: # również błędy serializacji, np. struct.error
+					error = e
+		finally:
+			executor.shutdown()
+		if error is not None:
+			for filename, dump in self.outputs: # także niedokończone pliki tymczasowe
+				if os.path.isfile(filename + ".tmp"):
+					os.remove(filename + ".tmp")
+			raise IOError("Could not write outputs: %s" % error)
+
+		directory = os.path.dirname(self.manifest_path)
+		entries = {}
+		if self.keep_entries and os.path.isfile(self.manifest_path):
+			entries = readManifest(self.manifest_path)
+		if os.path.isfile(self.manifest_path):
+			os.remove(self.manifest_path)
+		for filename, temporary, crc, size in results:
+			replaceFile(temporary, filename)
+			entries[os.path.relpath(filename, directory)] = (crc, size)
+		print("Wrote %d files, writing manifest %s" % (len(results), self.manifest_path))
+		temporary, crc, size = self.write_temporary(self.manifest_path, lambda: dumpManifest(entries))
+		replaceFile(temporary, self.manifest_path)
+
+def writeTMFFile(outputs, mesh, bv, file_path, options):
 	tmf_filename = os.path.splitext(file_path)[0] + ".tmf"
-	file = open(tmf_filename, "wb")
-	file.write(pack('BBBB', ord('T'), ord('M'), ord('F'), ord('2')))
-	file.write(mesh.dump_tmf())
-	file.write(bv.dump())
-	file.close()
+	def dump():
+		if options.vertex_streams:
+			data = pack('BBBB', ord('T'), ord('M'), ord('F'), ord('3'))
+			data += mesh.dump_streams(createVertexFormat(mesh, False, options), options.mesh_flags())
+		else:
+			data = pack('BBBB', ord('T'), ord('M'), ord('F'), ord('2'))
+			data += mesh.dump_tmf()
+		return data + bv.dump()
+	outputs.add(tmf_filename, dump)
 
-def writeSMFFile(mesh, bv, file_path):
+def writeSMFFile(outputs, mesh, bv, file_path, options):
 	smf_filename = os.path.splitext(file_path)[0] + ".smf"
-	file = open(smf_filename, "wb")
-	file.write(pack('BBBBI', ord('S'), ord('M'), ord('F'), ord('2'), 1))
-	file.write(mesh.dump())
-	file.write(bv.dump())
-	file.close()
+	def dump():
+		if options.vertex_streams:
+			data = pack('BBBBI', ord('S'), ord('M'), ord('F'), ord('3'), 1)
+			data += mesh.dump_streams(createVertexFormat(mesh, True, options), options.mesh_flags())
+		else:
+			data = pack('BBBBI', ord('S'), ord('M'), ord('F'), ord('2'), 1)
+			data += mesh.dump()
+		return data + bv.dump()
+	outputs.add(smf_filename, dump)
 
-def writeSAFFile(skeleton, file_path):
+def writeSAFFile(outputs, skeleton, file_path):
 	saf_filename = os.path.splitext(file_path)[0] + ".saf"
-	file = open(saf_filename, "wb")
-	file.write(pack('BBBB', ord('S'), ord('A'), ord('F'), ord('2')))
-	file.write(skeleton.dump())
-	file.close()
+	outputs.add(saf_filename, lambda: pack('BBBB', ord('S'), ord('A'), ord('F'), ord('4')) + skeleton.dump())
 
-def writeMTFFile(material, file_path):
+def writeMTFFile(outputs, material, file_path):
 	mtf_filename = os.path.dirname(file_path) + "/" + material.name + ".mtf"
-	file = open(mtf_filename, "wb")
-	file.write(pack('BBBB', ord('M'), ord('T'), ord('F'), ord('2')))
-	file.write(material.dump())
-	file.close()
+	outputs.add(mtf_filename, lambda: pack('BBBB', ord('M'), ord('T'), ord('F'), ord('2')) + material.dump())
 
-def write_materials(materials, file_path):
+def write_materials(outputs, materials, file_path):
 	for material in materials.materials:
 		if isinstance(material, Material):
-			writeMTFFile(material, file_path)
+			writeMTFFile(outputs, material, file_path)
 
-def write_i2n(exported_mesh, file_path, skeleton = None):
+def i2nSections(exported_mesh, file_path, skeleton = None):
+	"""
+		Zawartość i2n: lista (nazwa sekcji, lista (indeks, nazwa)).
+	"""
+	skeleton_name = os.path.basename(file_path)
+	skeleton_name = os.path.splitext(skeleton_name)[0]
+	sections = []
+	entries = []
+	materials = exported_mesh.materials.materials
+	for i in range(len(materials)):
+		if isinstance(materials[i], Material):
+			entries.append((i, materials[i].name))
+	sections.append(("materials", entries))
+	entries = []
+	for i in range(len(exported_mesh.textures)):
+		entries.append((i + 1, exported_mesh.textures[i]))
+	sections.append(("textures", entries))
+	if skeleton:
+		sections.append(("skeleton", [(1, skeleton_name)]))
+		sections.append(("joints", [(i, skeleton.joints[i].name) for i in range(len(skeleton.joints))]))
+		sections.append(("animations", [(i, skeleton.animations[i].name) for i in range(len(skeleton.animations))]))
+	return sections
+
+def write_i2n(outputs, exported_mesh, file_path, skeleton = None, binary = False):
+		sections = i2nSections(exported_mesh, file_path, skeleton)
+		if binary:
+			i2n_filename = os.path.dirname(file_path) + "/i2n.bin"
+			outputs.add(i2n_filename, lambda: dumpBinaryI2n(sections))
+			return
 		i2n_filename = os.path.dirname(file_path) + "/i2n"
-		skeleton_name = os.path.basename(file_path)
-		skeleton_name = os.path.splitext(skeleton_name)[0]
-		file = open(i2n_filename, "w")
-		file.write("#materials\n")
-		materials = exported_mesh.materials.materials
-		for i in range(len(materials)):
-			if isinstance(materials[i], Material):
-				file.write("%d. %s\n" % (i, materials[i].name))
-		file.write("#textures\n")
-		for i in range(len(exported_mesh.textures)):
-			file.write("%d. %s\n" % (i + 1, exported_mesh.textures[i]))
-		if skeleton:
-			file.write("#skeleton\n1. %s\n" % skeleton_name)
-			file.write("#joints\n")
-			for i in range(len(skeleton.joints)):
-				file.write("%d. %s\n" % (i, skeleton.joints[i].name))
-			file.write("#animations\n")
-			for i in range(len(skeleton.animations)):
-				file.write("%d. %s\n" % (i, skeleton.animations[i].name))
+		outputs.add(i2n_filename, lambda: dumpTextI2n(sections))
 
 def create_vertex(bl_vertex, object, object_id, mesh, cloning = False):
 	hab_vertex = SkinVertex4()
@@ -592,7 +965,44 @@ def create_vertex(bl_vertex, object, object_id, mesh, cloning = False):
 		mesh.vertex_bl_to_hab[(object_id, bl_vertex.index)] = hab_vertex
 	return hab_vertex
 
-def getMesh(exported_mesh, object, object_id):
+def getUVLayers(bl_mesh):
+	"""
+		Wszystkie warstwy UV, aktywna jako pierwsza (to ona trafia do tex_coord).
+	"""
+	active = bl_mesh.uv_textures.active
+	if active is None:
+		return []
+	return [active] + [layer for layer in bl_mesh.uv_textures if layer.name != active.name]
+
+def getCornerKey(uv_layers, color_layers, face_index, counter):
+	"""
+		Atrybuty rogu ściany ze wszystkich warstw naraz: najpierw UV, potem kolory.
+		Szew na dowolnej warstwie wymusza zduplikowanie wierzchołka.
+	"""
+	key = []
+	for uv_layer in uv_layers:
+		uv = uv_layer.data[face_index].uv[counter]
+		key.append((uv[0], 1.0 - uv[1])) # taka przypadłość blendera
+	for color_layer in color_layers:
+		color = getattr(color_layer.data[face_index], "color%d" % (counter + 1))
+		key.append((color[0], color[1], color[2]))
+	return tuple(key)
+
+def equalKeys(key1, key2):
+	for values1, values2 in zip(key1, key2):
+		for a, b in zip(values1, values2):
+			if not equal(a, b):
+				return False
+	return True
+
+def setCornerAttributes(vertex, key, uv_count):
+	vertex.corner_key = key
+	vertex.tex_coords = [Vector2f(uv[0], uv[1]) for uv in key[:uv_count]]
+	vertex.colors = [Color(color) for color in key[uv_count:]]
+	if vertex.tex_coords:
+		vertex.tex_coord.set_values(key[0])
+
+def getMesh(exported_mesh, object, object_id, options = None):
 	print("Parsing mesh.")
 	bl_mesh = object.data
 	hab_mesh = exported_mesh.mesh
@@ -609,39 +1019,196 @@ def getMesh(exported_mesh, object, object_id):
 	for bl_material in bl_mesh.materials:
 		exported_mesh.materials.add(bl_material)
 
-	uv_layer = bl_mesh.uv_textures.active # for texture coords
-	print("Reading %d faces." % len(bl_mesh.faces))
+	uv_layers = getUVLayers(bl_mesh) # for texture coords
+	color_layers = list(bl_mesh.vertex_colors)
+	if options is None or not options.vertex_streams: # SMF2/TMF2 mają tylko aktywną warstwę UV
+		uv_layers = uv_layers[:1]
+		color_layers = []
+	print("Reading %d faces (%d uv layers, %d color layers)." %
+		  (len(bl_mesh.faces), len(uv_layers), len(color_layers)))
 	for bl_face in bl_mesh.faces:
 		face_index = bl_face.index
 		material_name = bl_mesh.materials[bl_face.material_index].name
 		sub_mesh = exported_mesh.materials.by_name[material_name].sub_mesh
 		counter = 0
 		for bl_vertex in bl_face.vertices:
-			coord_x = 0.
-			coord_y = 0.
-			if uv_layer is not None:
-				coord_x = uv_layer.data[face_index].uv[counter][0]
-				coord_y = 1.0 - uv_layer.data[face_index].uv[counter][1] # taka przypadłość blendera
+			key = getCornerKey(uv_layers, color_layers, face_index, counter)
 			vertex = exported_mesh.vertex_bl_to_hab[(object_id, bl_vertex)]
-			if ( equal(vertex.tex_coord.x, coord_x) and equal(vertex.tex_coord.y, coord_y)
-				or vertex.tex_coord == Vector2f(0.0, 0.0) ):
-				
+			if vertex.corner_key is None or equalKeys(vertex.corner_key, key):
 				sub_mesh.vertices.append(vertex)
-				vertex.tex_coord.set_values([coord_x, coord_y])
-			else:# wierzchołek już ma przypisane koordynaty, sprawdzamy czy musimy zduplikować
-				if (coord_x, coord_y) in vertex.cloned:
-					sub_mesh.vertices.append(vertex.cloned[(coord_x, coord_y)])
+				if vertex.corner_key is None:
+					setCornerAttributes(vertex, key, len(uv_layers))
+			else:# wierzchołek już ma przypisane atrybuty, sprawdzamy czy musimy zduplikować
+				if key in vertex.cloned:
+					sub_mesh.vertices.append(vertex.cloned[key])
 				else: #trzeba zduplikować
 					new_vertex = create_vertex(bl_mesh.vertices[bl_vertex], object, object_id, exported_mesh, True)
 					hab_mesh.vertices.append(new_vertex)
-					new_vertex.tex_coord.set_values([coord_x, coord_y])
+					setCornerAttributes(new_vertex, key, len(uv_layers))
 					sub_mesh.vertices.append(new_vertex)
-					vertex.cloned[(coord_x, coord_y)] = new_vertex
+					vertex.cloned[key] = new_vertex
 			counter += 1
 	for sub_mesh in exported_mesh.mesh.sub_meshes:
 		print("Read submesh with material %s: %d indices" % (sub_mesh.material.name, len(sub_mesh.vertices)))
 
-def getSkeletalAnimation(exported_mesh, armature_obj, all_groups):
+def getJointBounds(exported_mesh):
+	"""
+		Dla każdego jointa liczy AABB wierzchołków (w bind pose), na które
+		ma niezerowy wpływ. Wierzchołki bez wag trafiają do osobnego,
+		statycznego AABB.
+	"""
+	joint_bounds = {}
+	static_bounds = BoundingVolume()
+	for vertex in exported_mesh.mesh.vertices:
+		influenced = False
+		for joint, weight in zip(vertex.joints, vertex.joint_weights):
+			if weight > 0.:
+				if joint not in joint_bounds:
+					joint_bounds[joint] = BoundingVolume()
+				joint_bounds[joint].update(vertex)
+				influenced = True
+		if not influenced:
+			static_bounds.update(vertex)
+	return joint_bounds, static_bounds
+
+def getSkinMatrices(armature_obj, rest_inverted):
+	"""
+		Macierze skinningu (w przestrzeni świata) wszystkich kości w aktualnej
+		pozie, po nazwie kości.
+	"""
+	armature_matrix = armature_obj.matrix_local
+	armature_inverted = armature_matrix.inverted()
+	matrices = {}
+	for pose_bone in armature_obj.pose.bones:
+		matrices[pose_bone.name] = armature_matrix * pose_bone.matrix * rest_inverted[pose_bone.name] * armature_inverted
+	return matrices
+
+def computeAnimationBounds(animation, joint_bounds, static_bounds):
+	"""
+		Przekształca AABB jointów przez pozy animacji w klatkach kluczowych.
+		Wierzchołek po skinningu jest kombinacją wypukłą swoich pozycji
+		przekształconych przez poszczególne jointy, więc suma tych AABB
+		obejmuje wszystkie klatki kluczowe. Pomiędzy nimi obroty są
+		interpolowane i wierzchołki mogą wyjść poza tę sumę, dlatego wynik
+		powiększamy z każdej strony o animationBoundsMargin przekątnej.
+		Jointy bez kości się nie ruszają.
+	"""
+	bounds = BoundingVolume()
+	bounds.merge(static_bounds)
+	for joint, joint_bb in joint_bounds.items():
+		corners = joint_bb.corners()
+		moved = False
+		for matrices in animation.skin_matrices:
+			matrix = matrices.get(joint.name)
+			if matrix is None:
+				break
+			for corner in corners:
+				bounds.update_point(matrix * corner)
+			moved = True
+		if not moved:
+			bounds.merge(joint_bb)
+	if not bounds.is_empty():
+		margin = animationBoundsMargin * math.sqrt((bounds.xmax - bounds.xmin) ** 2 +
+			(bounds.ymax - bounds.ymin) ** 2 + (bounds.zmax - bounds.zmin) ** 2)
+		bounds.xmin -= margin
+		bounds.ymin -= margin
+		bounds.zmin -= margin
+		bounds.xmax += margin
+		bounds.ymax += margin
+		bounds.zmax += margin
+	animation.bounding_volume = bounds
+	print("Animation %s bounding volume:" % animation.name)
+	print("%f %f %f %f %f %f" % (bounds.xmin, bounds.ymin, bounds.zmin, bounds.xmax, bounds.ymax, bounds.zmax))
+
+def updateSkeletonBounds(exported_mesh):
+	"""
+		Liczy AABB wszystkich animacji od nowa z zapamiętanych macierzy,
+		np. gdy zmieniła się sama siatka.
+	"""
+	joint_bounds, static_bounds = getJointBounds(exported_mesh)
+	for animation in exported_mesh.skeleton.animations:
+		computeAnimationBounds(animation, joint_bounds, static_bounds)
+
+def computeTangents(mesh):
+	"""
+		Liczy tangent i znak bitangenta dla każdego wierzchołka. Tangent
+		trójkąta jest normalizowany i rzutowany na płaszczyznę normalnej
+		wierzchołka, a dopiero potem sumowany z wagą kąta przy wierzchołku,
+		więc gęstość UV trójkąta nie ma wpływu na wynik. Wierzchołek, którego
+		trójkąty mają różne znaki bitangenta (lustrzane UV), jest dzielony:
+		trójkąty z ujemnym znakiem dostają jego klona. Szwy UV są już
+		rozcięte przez klonowanie wierzchołków w getMesh. To nie jest
+		implementacja MikkTSpace i wyniki mogą się od niego różnić.
+	"""
+	print("Computing tangents.")
+	faces = [] # (sub_mesh, pierwszy indeks, tangent, bitangent, kąty)
+	signs = {} # id wierzchołka -> znaki bitangenta w jego trójkątach
+	for sub_mesh in mesh.sub_meshes:
+		triangles = sub_mesh.vertices
+		for i in range(0, len(triangles) - 2, 3):
+			corners = triangles[i:i + 3]
+			positions = [Vector((v.position.x, v.position.y, v.position.z)) for v in corners]
+			edge1 = positions[1] - positions[0]
+			edge2 = positions[2] - positions[0]
+			du1 = corners[1].tex_coord.x - corners[0].tex_coord.x
+			dv1 = corners[1].tex_coord.y - corners[0].tex_coord.y
+			du2 = corners[2].tex_coord.x - corners[0].tex_coord.x
+			dv2 = corners[2].tex_coord.y - corners[0].tex_coord.y
+			det = du1 * dv2 - du2 * dv1
+			if abs(det) < 1e-12: # zdegenerowane UV
+				continue
+			tangent = (edge1 * dv2 - edge2 * dv1) / det
+			bitangent = (edge2 * du1 - edge1 * du2) / det
+			angles = []
+			for j in range(3):
+				a = positions[(j + 1) % 3] - positions[j]
+				b = positions[(j + 2) % 3] - positions[j]
+				if a.length < 1e-12 or b.length < 1e-12:
+					angles.append(0.)
+				else:
+					angles.append(a.angle(b))
+			corner_signs = []
+			for vertex in corners:
+				normal = Vector((vertex.normal.x, vertex.normal.y, vertex.normal.z))
+				sign = 1. if normal.cross(tangent).dot(bitangent) >= 0. else -1.
+				signs.setdefault(vertex.id, set()).add(sign)
+				corner_signs.append(sign)
+			faces.append((sub_mesh, i, tangent, corner_signs, angles))
+	mirrored = {} # id wierzchołka -> klon dla trójkątów z ujemnym znakiem
+	for vertex in list(mesh.vertices):
+		if len(signs.get(vertex.id, ())) == 2:
+			clone = copy.copy(vertex)
+			clone.cloned = {}
+			mesh.vertices.append(clone)
+			mirrored[vertex.id] = clone
+	if mirrored:
+		print("Split %d vertices with mirrored UVs." % len(mirrored))
+	tangents = [Vector((0., 0., 0.)) for _ in mesh.vertices]
+	vertex_signs = [1.] * len(mesh.vertices)
+	for sub_mesh, i, tangent, corner_signs, angles in faces:
+		for j in range(3):
+			vertex = sub_mesh.vertices[i + j]
+			if corner_signs[j] < 0. and vertex.id in mirrored:
+				vertex = mirrored[vertex.id]
+				sub_mesh.vertices[i + j] = vertex
+			normal = Vector((vertex.normal.x, vertex.normal.y, vertex.normal.z))
+			projected = tangent - normal * normal.dot(tangent)
+			if projected.length < 1e-12:
+				continue
+			projected.normalize()
+			tangents[vertex.id] += projected * angles[j]
+			vertex_signs[vertex.id] = corner_signs[j]
+	for vertex in mesh.vertices:
+		normal = Vector((vertex.normal.x, vertex.normal.y, vertex.normal.z))
+		tangent = tangents[vertex.id]
+		tangent = tangent - normal * normal.dot(tangent)
+		if tangent.length < 1e-12: # brak UV, bierzemy dowolny prostopadły
+			axis = Vector((1., 0., 0.)) if abs(normal.x) < 0.9 else Vector((0., 1., 0.))
+			tangent = axis - normal * normal.dot(axis)
+		tangent.normalize()
+		vertex.tangent = (tangent.x, tangent.y, tangent.z, vertex_signs[vertex.id])
+
+def getSkeletalAnimation(exported_mesh, armature_obj, all_groups, options = None, cached = None):
 	print("Parsing animations.")
 	armature = armature_obj.data
 	hab_skeleton = exported_mesh.skeleton
@@ -651,6 +1218,7 @@ def getSkeletalAnimation(exported_mesh, armature_obj, all_groups):
 		if bone.name not in all_groups.by_name:
 			all_groups.add_empty(bone.name)
 		joint = all_groups.by_name[bone.name]
+		joint.inverse_bind.get_from_matrix((armature_obj.matrix_local * bone.matrix_local).inverted())
 		if bone.parent is None:
 			joint.parent = None
 			joint.matrix = armature_obj.matrix_local * bone.matrix_local
@@ -659,42 +1227,191 @@ def getSkeletalAnimation(exported_mesh, armature_obj, all_groups):
 				SetJointsPose(child_bone, all_groups)
 	hab_skeleton.joints = all_groups.joints
 
+	joint_ids = {}
+	for joint in hab_skeleton.joints:
+		joint_ids[joint.name] = joint.id
+	reused = {}
+	if cached is not None:
+		reused = cached.get(hab_skeleton.joints)
+	actions = [action for action in bpy.data.actions if action.name not in reused]
+	sampled = {}
+	workers = options.animation_workers if options else 0
+	if workers > 1 and len(actions) > 1:
+		if not options.blend_saved:
+			print("Blend file not saved, workers would not see the changes. Sampling animations serially.")
+		else:
+			sampled = sampleActionsInWorkers(armature_obj, actions, hab_skeleton.joints, workers)
+
+	rest_inverted, frame_length = prepareSampling(armature_obj)
+	print("Reading animations:")
+	for action in bpy.data.actions:
+		if action.name in reused:
+			print("%s (unchanged)" % action.name)
+			animation = reused[action.name]
+		elif action.name in sampled:
+			animation = sampled[action.name]
+		else:
+			animation = sampleAction(armature_obj, action, joint_ids, len(hab_skeleton.joints), rest_inverted, frame_length)
+		hab_skeleton.animations.append(animation)
+	return hab_skeleton
+
+def prepareSampling(armature_obj):
+	"""
+		Zwraca odwrotności macierzy spoczynkowych kości i długość klatki.
+		Pozy bierzemy z pose.bones po scene.frame_set, więc nie trzeba ani
+		zaznaczać armatury, ani przechodzić w tryb pozy.
+	"""
 	scene = bpy.context.scene
 	fps = scene.render.fps
 	frame_length = (1. / fps)
 
-	for object in scene.objects:
-		object.select = False
-	armature_obj.select = True
-	scene.objects.active = armature_obj
-	bpy.ops.object.mode_set(mode='POSE')
-	print("Reading animations:")
-	for action in bpy.data.actions:
-		armature_obj.animation_data.action = action
+	rest_inverted = {}
+	for bone in armature_obj.data.bones:
+		rest_inverted[bone.name] = bone.matrix_local.inverted()
+	return rest_inverted, frame_length
+
+def getActionFrames(action, scene):
+	"""
+		Klatki do spróbkowania, jak przy skokach po klatkach kluczowych:
+		początek sceny i kolejne klatki kluczowe akcji.
+	"""
+	keys = set([scene.frame_start])
+	for fcurve in action.fcurves:
+		for point in fcurve.keyframe_points:
+			frame = int(round(point.co[0]))
+			if frame > scene.frame_start:
+				keys.add(frame)
+	return sorted(keys)
+
+def sampleAction(armature_obj, action, joint_ids, joint_count, rest_inverted, frame_length):
+	scene = bpy.context.scene
+	armature_obj.animation_data.action = action
+	animation = SkeletalAnimation()
+	animation.name = action.name
+	print(animation.name)
+	sequences = animation.keyframe_sequences
+	for _ in range(joint_count): # creating sequences
+		seq = SkeletonJointKeyframeSequence()
+		sequences.append(seq)
+	for frame in getActionFrames(action, scene): # filling sequences
+		scene.frame_set(frame)
+		print("Jumped to frame %d" % frame)
+		time = frame_length * frame
+		for sequence in sequences: #creating keyframes
+			keyframe = SkeletonJointKeyframe()
+			keyframe.beginTime = time
+			sequence.frames.append(keyframe)
+		for bone in armature_obj.pose.bones:
+			sequences[joint_ids[bone.name]].frames[-1].pose.translation.set_values(bone.location)
+			sequences[joint_ids[bone.name]].frames[-1].pose.rotation.set_values(bone.rotation_quaternion)
+		animation.skin_matrices.append(getSkinMatrices(armature_obj, rest_inverted))
+	return animation
+
+def dumpPartialAnimations(animations, joint_ids):
+	"""
+		Plik częściowy workera: nazwy animacji, sekwencje klatek (jak w SAF)
+		i macierze skinningu potrzebne do AABB.
+	"""
+	data = pack('BBBBI', ord('H'), ord('P'), ord('A'), ord('1'), len(animations))
+	for animation in animations:
+		name = animation.name.encode("utf-8")
+		data += pack('I', len(name)) + name
+		data += pack('II', len(animation.keyframe_sequences), len(animation.skin_matrices))
+		data += animation.keyframe_sequences.dump()
+		for matrices in animation.skin_matrices:
+			data += pack('I', len(matrices))
+			for bone_name in sorted(matrices):
+				values = [value for row in matrices[bone_name] for value in row]
+				data += pack('I16f', joint_ids[bone_name], *values)
+	return data
+
+def readPartialAnimations(data, joint_names):
+	if data[0:4] != b"HPA1":
+		raise IOError("Not a partial animation file")
+	count = unpack_from('I', data, 4)[0]
+	offset = 8
+	animations = []
+	for i in range(count):
 		animation = SkeletalAnimation()
-		animation.name = action.name
-		print(animation.name)
-		sequences = animation.keyframe_sequences
-		for _ in hab_skeleton.joints: # creating sequences
-			seq = SkeletonJointKeyframeSequence()
-			sequences.append(seq)
-		frame = -100000
-		bpy.ops.screen.frame_jump()
-		while frame < scene.frame_current: # filling sequences
-			frame = scene.frame_current
-			scene.frame_set(frame)
-			print("Jumped to frame %d" % frame)
-			time = frame_length * frame
-			for sequence in sequences: #creating keyframes
+		length = unpack_from('I', data, offset)[0]
+		offset += 4
+		animation.name = data[offset:offset + length].decode("utf-8")
+		offset += length
+		sequence_count, frame_count = unpack_from('II', data, offset)
+		offset += 8
+		for j in range(sequence_count):
+			sequence = SkeletonJointKeyframeSequence()
+			keyframe_count = unpack_from('I', data, offset)[0]
+			offset += 4
+			for k in range(keyframe_count):
+				values = unpack_from('ffffffff', data, offset)
+				offset += 32
 				keyframe = SkeletonJointKeyframe()
-				keyframe.beginTime = time
+				keyframe.beginTime = values[0]
+				keyframe.pose.rotation.set_values(values[1:5])
+				keyframe.pose.translation.set_values(values[5:8])
 				sequence.frames.append(keyframe)
-			for bone in armature_obj.pose.bones:
-				sequences[all_groups.by_name[bone.name].id].frames[-1].pose.translation.set_values(bone.location)
-				sequences[all_groups.by_name[bone.name].id].frames[-1].pose.rotation.set_values(bone.rotation_quaternion)
-			bpy.ops.screen.keyframe_jump()
-		hab_skeleton.animations.append(animation)
-	return hab_skeleton
+			animation.keyframe_sequences.append(sequence)
+		for j in range(frame_count):
+			matrices = {}
+			matrix_count = unpack_from('I', data, offset)[0]
+			offset += 4
+			for k in range(matrix_count):
+				values = unpack_from('I16f', data, offset)
+				offset += 68
+				matrices[joint_names[values[0]]] = Matrix((values[1:5], values[5:9], values[9:13], values[13:17]))
+			animation.skin_matrices.append(matrices)
+		animations.append(animation)
+	return animations
+
+workerScript = """import bpy
+import sys
+bpy.ops.export_anim.hab_actions(jobpath=sys.argv[sys.argv.index("--") + 1])
+"""
+
+def sampleActionsInWorkers(armature_obj, actions, joints, workers):
+	"""
+		Rozdziela akcje między workers procesów blendera uruchomionych w tle
+		na zapisanym pliku .blend. Każdy zapisuje swoje animacje do pliku
+		częściowego. Zwraca słownik nazwa akcji -> SkeletalAnimation; akcje,
+		których workerom nie udało się spróbkować, po prostu w nim nie ma.
+	"""
+	directory = tempfile.mkdtemp(prefix="habanero")
+	script = os.path.join(directory, "worker.py")
+	file = open(script, "w")
+	file.write(workerScript)
+	file.close()
+	joint_names = [joint.name for joint in joints]
+	processes = []
+	for i in range(workers):
+		shard = [action.name for action in actions[i::workers]]
+		if not shard:
+			continue
+		job = {
+			"armature": armature_obj.name,
+			"joints": joint_names,
+			"actions": shard,
+			"output": os.path.join(directory, "part%d.hpa" % i),
+		}
+		job_path = os.path.join(directory, "job%d.json" % i)
+		file = open(job_path, "w")
+		json.dump(job, file)
+		file.close()
+		print("Starting worker %d for %d actions" % (i, len(shard)))
+		process = subprocess.Popen([bpy.app.binary_path, "-b", bpy.data.filepath, "-P", script, "--", job_path])
+		processes.append((job, process))
+	sampled = {}
+	for job, process in processes:
+		process.wait()
+		if process.returncode != 0 or not os.path.isfile(job["output"]):
+			print("Worker failed, its actions will be sampled here: %s" % ", ".join(job["actions"]))
+			continue
+		file = open(job["output"], "rb")
+		for animation in readPartialAnimations(file.read(), joint_names):
+			sampled[animation.name] = animation
+		file.close()
+	shutil.rmtree(directory, True)
+	return sampled
 
 def SetJointsPose(bone, all_groups):
 	if bone.name not in all_groups.by_name:
@@ -760,74 +1477,331 @@ def getGroups(object, index, all_groups):
 		all_groups.add(index, group)
 
 
-def writeFiles(filename, toTMF):
-	print("Saving scene to %s" % filename)
-	objects = []
-	triangulates = []
-	for object in bpy.data.objects:
-		if object.type == 'MESH':
-			triangulated, obj = triangulateMesh(object)
-			objects.append(obj)
-			triangulates.append(triangulated)
+def removeTriangulated(object):
+	"""
+		Usuwa kopię obiektu zrobioną przez triangulateMesh razem z jej siatką,
+		bez operatorów i bez osieroconych danych w pliku.
+	"""
+	print("Removing triangulated object...")
+	mesh = object.data
+	bpy.context.scene.objects.unlink(object)
+	bpy.data.objects.remove(object)
+	bpy.data.meshes.remove(mesh)
 
+def parseObject(object, object_id, options, all_groups):
+	"""
+		Triangulacja i wczytanie jednej siatki do osobnego ExportedMesh;
+		wspólne z innymi obiektami są tylko grupy. Części łączy mergeMeshes.
+	"""
+	triangulated, obj = triangulateMesh(object)
+	part = ExportedMesh()
+	part.groups = all_groups
+	getGroups(obj, object_id, all_groups)
+	getMesh(part, obj, object_id, options)
+	if options.tangents:
+		computeTangents(part.mesh)
+	if triangulated:
+		removeTriangulated(obj)
+	return part
+
+def mergeMeshes(parts, all_groups):
+	"""
+		Skleja siatki wczytane przez parseObject w jedną, w kolejności
+		obiektów. Materiały (i tekstury) są czytane od nowa z bpy.data, więc
+		mają te same numery, co przy wczytaniu wszystkiego naraz.
+	"""
 	exported_mesh = ExportedMesh()
-
-	all_groups = Groups()
-	for i in range(len(objects)):
-		getGroups(objects[i], i, all_groups)
-	print("Number of groups: %d" % len(all_groups.joints))
 	exported_mesh.groups = all_groups
+	for part in parts:
+		for vertex in part.mesh.vertices:
+			exported_mesh.mesh.vertices.append(vertex)
+		exported_mesh.bb.merge(part.bb)
+		for sub_mesh in part.mesh.sub_meshes:
+			name = sub_mesh.material.name
+			exported_mesh.materials.add(bpy.data.materials[name])
+			exported_mesh.materials.by_name[name].sub_mesh.vertices.extend(sub_mesh.vertices)
+	return exported_mesh
+
+def parseMeshes(options, all_groups = None, parts = None):
+	"""
+		Triangulacja i wczytanie wszystkich siatek. Można podać istniejące
+		Groups, wtedy jointy (i ich indeksy) są zachowywane, a nowe grupy
+		dopisywane na końcu. parts (nazwa obiektu -> ExportedMesh z
+		parseObject) to siatki wczytane wcześniej: obiekty, które tam są, nie
+		są wczytywane ponownie, nowe są dopisywane, a usunięte wyrzucane.
+	"""
+	if all_groups is None:
+		all_groups = Groups()
+	if parts is None:
+		parts = {}
+	objects = [object for object in bpy.data.objects if object.type == 'MESH']
+	names = set([object.name for object in objects])
+	for name in list(parts):
+		if name not in names:
+			del parts[name]
 	for i in range(len(objects)):
-		getMesh(exported_mesh, objects[i], i)
-	if toTMF:
-		try:
-			writeTMFFile(exported_mesh.mesh, exported_mesh.bb, filename)
-			write_materials(exported_mesh.materials, filename)
-			write_i2n(exported_mesh, filename)
-		except IOError:
-			print("IOError.")
-	else:
-		exported_mesh.skeleton = Skeleton()
-		for object in bpy.data.objects:
-			if object.type == 'ARMATURE':
-				getSkeletalAnimation(exported_mesh, object, all_groups)
-		OptimizeAnimations(exported_mesh.skeleton)
-		try:
-			writeSMFFile(exported_mesh.mesh, exported_mesh.bb, filename)
-			writeSAFFile(exported_mesh.skeleton, filename)
-			write_materials(exported_mesh.materials, filename)
-			write_i2n(exported_mesh, filename, exported_mesh.skeleton)
-		except IOError:
-			print("IOError.")
+		if objects[i].name in parts:
+			print("Mesh %s unchanged." % objects[i].name)
+		else:
+			parts[objects[i].name] = parseObject(objects[i], i, options, all_groups)
+	print("Number of groups: %d" % len(all_groups.joints))
+	exported_mesh = mergeMeshes([parts[object.name] for object in objects], all_groups)
 
 	vertices = {}
 	for vertex in exported_mesh.mesh.vertices:
-		if (vertex.position, vertex.tex_coord) in vertices:
+		# corner_key ma też pozostałe warstwy UV i kolory, przez które klonujemy,
+		# a lustrzane UV rozcina computeTangents
+		key = (vertex.position, vertex.tex_coord, vertex.corner_key, vertex.tangent[3]) # i znak bitangenta
+		if key in vertices:
 			print("Duplicated vertex detected!")
 			print(vertex)
-			print(vertices[(vertex.position, vertex.tex_coord)])
+			print(vertices[key])
 		else:
-			vertices[(vertex.position, vertex.tex_coord)] = vertex
+			vertices[key] = vertex
 
-	scene = bpy.context.scene
-	for i in scene.objects: i.select = False #deselect all objects
+	if options.batch_cell_size > 0.: # batche i tak mają wierzchołki w kolejności użycia
+		batchStaticMesh(exported_mesh.mesh, options.batch_cell_size)
+	elif options.compress_indices:
+		exported_mesh.mesh.optimize_vertex_fetch()
+	return exported_mesh
 
-	for i in range(len(objects)):
-		object = objects[i]
-		if triangulates[i]:
-			print("Removing triangulated object...")
-			object.select = True
-			scene.objects.active = object #set the mesh object to current
-	bpy.ops.object.mode_set(mode='OBJECT')
-	bpy.ops.object.delete()
+def parseSkeleton(exported_mesh, options, cached = None):
+	exported_mesh.skeleton = Skeleton()
+	for object in bpy.data.objects:
+		if object.type == 'ARMATURE':
+			getSkeletalAnimation(exported_mesh, object, exported_mesh.groups, options, cached)
+	sortSkeletonJoints(exported_mesh.skeleton)
+	updateSkeletonBounds(exported_mesh)
+	OptimizeAnimations(exported_mesh.skeleton)
 
-class ExportToHabanero(bpy.types.Operator):
-	"""Export Skeleton Mesh / Skeletal Animation file(s)"""
-	global exportMessage
-	bl_idname = "export_mesh.hab"
-	bl_label = "Export SMF/SAF"
-	__doc__ = """Select one mesh to be exported."""
-	
+def writeOutputs(exported_mesh, filename, toTMF, options, write_mesh = True, write_animations = True):
+	"""
+		Zapisuje pliki wyjściowe jako jeden zestaw (patrz OutputSet).
+		W razie błędu rzuca IOError, a stare pliki zostają nietknięte.
+	"""
+	outputs = OutputSet(filename, not write_mesh)
+	if toTMF:
+		writeTMFFile(outputs, exported_mesh.mesh, exported_mesh.bb, filename, options)
+		write_materials(outputs, exported_mesh.materials, filename)
+		write_i2n(outputs, exported_mesh, filename, None, options.binary_i2n)
+	else:
+		if write_mesh:
+			writeSMFFile(outputs, exported_mesh.mesh, exported_mesh.bb, filename, options)
+		if write_animations:
+			writeSAFFile(outputs, exported_mesh.skeleton, filename)
+		if write_mesh:
+			write_materials(outputs, exported_mesh.materials, filename)
+		write_i2n(outputs, exported_mesh, filename, exported_mesh.skeleton, options.binary_i2n)
+	outputs.commit()
+
+def writeFiles(filename, toTMF, options = None):
+	if options is None:
+		options = ExportOptions()
+	print("Saving scene to %s" % filename)
+	# sprawdzamy przed parseMeshes - triangulacja zmienia plik
+	options.blend_saved = bpy.data.filepath != "" and not bpy.data.is_dirty
+	exported_mesh = parseMeshes(options)
+	if not toTMF:
+		parseSkeleton(exported_mesh, options)
+	writeOutputs(exported_mesh, filename, toTMF, options)
+
+def usedJointNames():
+	names = set()
+	for object in bpy.data.objects:
+		if object.type == 'MESH':
+			for group in object.vertex_groups:
+				names.add(group.name)
+		elif object.type == 'ARMATURE':
+			for bone in object.data.bones:
+				names.add(bone.name)
+	return names
+
+class AnimationCache:
+	"""
+		Animacje z poprzedniego eksportu w trybie obserwowania, poza akcjami
+		zmienionymi od tamtej pory. Można ich użyć tylko przy tej samej
+		kolejności jointów (to ona wyznacza kolejność sekwencji klatek).
+	"""
+	def __init__(self, skeleton, changed_actions):
+		self.joint_names = [joint.name for joint in skeleton.joints]
+		self.animations = {}
+		for animation in skeleton.animations:
+			if animation.name not in changed_actions:
+				self.animations[animation.name] = animation
+
+	def get(self, joints):
+		if [joint.name for joint in joints] != self.joint_names:
+			return {}
+		return self.animations
+
+class SessionState:
+	"""
+		To, co eksport zmienia w sesji artysty: bieżąca klatka, akcje
+		przypisane obiektom, zaznaczenie, aktywny obiekt i jego tryb.
+	"""
+	def __init__(self):
+		scene = bpy.context.scene
+		self.frame = scene.frame_current
+		self.actions = {}
+		for object in bpy.data.objects:
+			if object.animation_data is not None:
+				self.actions[object.name] = object.animation_data.action
+		self.selected = set([object.name for object in scene.objects if object.select])
+		active = scene.objects.active
+		self.active = None
+		self.mode = 'OBJECT'
+		if active is not None:
+			self.active = active.name
+			self.mode = active.mode
+
+	def restore(self):
+		scene = bpy.context.scene
+		for name, action in self.actions.items():
+			object = bpy.data.objects.get(name)
+			if object is not None and object.animation_data is not None:
+				object.animation_data.action = action
+		scene.frame_set(self.frame)
+		for object in scene.objects:
+			object.select = object.name in self.selected
+		active = None
+		if self.active is not None:
+			active = scene.objects.get(self.active)
+		scene.objects.active = active
+		if active is not None and active.mode != self.mode:
+			bpy.ops.object.mode_set(mode=self.mode)
+
+class WatchState:
+	"""
+		Stan trybu obserwowania: trzyma wczytane siatki (osobno dla każdego
+		obiektu), grupy i szkielet między eksportami i pamięta, co się
+		zmieniło od ostatniego razu. Eksport robimy po zapisie pliku, z timera
+		operatora WatchHabanero, a nie w samym handlerze zapisu.
+	"""
+	def __init__(self, filename, toTMF, options):
+		self.filename = filename
+		self.toTMF = toTMF
+		self.options = options
+		self.exported_mesh = None
+		self.parts = {} # nazwa obiektu -> ExportedMesh z parseObject
+		self.dirty_objects = set() # nazwy siatek zmienionych od ostatniego eksportu
+		self.dirty_meshes = True # trzeba zapisać siatkę (zmiana siatki, obiektu albo materiału)
+		self.dirty_animations = True # wszystkie akcje (np. zmieniła się armatura)
+		self.dirty_actions = set() # nazwy akcji zmienionych od ostatniego eksportu
+		self.busy = False # ignorujemy zmiany, które robi sam eksport
+		self.pending = False # plik został zapisany, eksport czeka na timer
+
+	def export(self):
+		self.pending = False
+		mesh_names = set([object.name for object in bpy.data.objects if object.type == 'MESH'])
+		if mesh_names != set(self.parts): # dodane albo usunięte obiekty
+			self.dirty_meshes = True
+		if not (self.dirty_meshes or self.dirty_animations or self.dirty_actions):
+			print("Nothing changed, skipping export.")
+			return
+		self.busy = True
+		session = SessionState()
+		try:
+			self.update()
+			self.dirty_meshes = False
+			self.dirty_objects = set()
+			self.dirty_animations = False
+			self.dirty_actions = set()
+		except IOError as e:
+			print("IOError: %s" % e)
+		finally:
+			session.restore()
+			# zmiany zrobione przez sam eksport przechodzą przez watchSceneUpdate teraz,
+			# póki busy jest ustawione, a nie w następnej aktualizacji sceny
+			bpy.context.scene.update()
+			self.busy = False
+
+	def update(self):
+		print("Re-exporting to %s (meshes: %s, animations: %s, actions: %s)" %
+			  (self.filename, ", ".join(sorted(self.dirty_objects)) or self.dirty_meshes,
+			   self.dirty_animations, ", ".join(sorted(self.dirty_actions))))
+		self.options.blend_saved = bpy.data.filepath != "" and not bpy.data.is_dirty
+		cached = self.exported_mesh
+		# stare jointy zachowujemy tylko, jeśli wszystkie nadal istnieją
+		keep_groups = cached is not None and set(cached.groups.by_name).issubset(usedJointNames())
+		if not keep_groups: # wierzchołki trzymają obiekty jointów, więc wczytujemy wszystko od nowa
+			self.parts = {}
+		for name in self.dirty_objects:
+			self.parts.pop(name, None)
+		write_mesh = self.dirty_meshes or not keep_groups
+		if write_mesh:
+			all_groups = None
+			if keep_groups:
+				all_groups = cached.groups
+			joint_count = len(all_groups.joints) if all_groups else -1
+			self.exported_mesh = parseMeshes(self.options, all_groups, self.parts)
+			if len(self.exported_mesh.groups.joints) != joint_count:
+				self.dirty_animations = True
+		if self.toTMF:
+			if write_mesh:
+				writeOutputs(self.exported_mesh, self.filename, True, self.options)
+			return
+		if self.dirty_animations or self.dirty_actions:
+			joint_names = [joint.name for joint in self.exported_mesh.groups.joints]
+			animations = None
+			if not self.dirty_animations:
+				animations = AnimationCache(cached.skeleton, self.dirty_actions)
+			parseSkeleton(self.exported_mesh, self.options, animations)
+			# nowe kości mogły zmienić kolejność jointów, a więc i indeksy w SMF
+			if joint_names != [joint.name for joint in self.exported_mesh.groups.joints]:
+				write_mesh = True
+		else: # animacje bez zmian, wystarczy przeliczyć AABB dla nowej siatki
+			self.exported_mesh.skeleton = cached.skeleton
+			updateSkeletonBounds(self.exported_mesh)
+		writeOutputs(self.exported_mesh, self.filename, False, self.options,
+					 write_mesh, True)
+
+watch_state = None
+
+@persistent
+def watchSceneUpdate(scene):
+	if watch_state is None or watch_state.busy:
+		return
+	# is_updated_data siatek z modyfikatorem armatury zmienia się przy każdym
+	# przewinięciu osi czasu, więc patrzymy na samą siatkę i transformację obiektu
+	if bpy.data.meshes.is_updated or bpy.data.objects.is_updated:
+		for object in scene.objects:
+			if object.type == 'MESH' and (object.is_updated or object.data.is_updated):
+				watch_state.dirty_objects.add(object.name)
+				watch_state.dirty_meshes = True
+	if bpy.data.materials.is_updated:
+		watch_state.dirty_meshes = True
+	if bpy.data.armatures.is_updated:
+		watch_state.dirty_animations = True
+	if bpy.data.actions.is_updated:
+		for action in bpy.data.actions:
+			if action.is_updated:
+				watch_state.dirty_actions.add(action.name)
+
+@persistent
+def watchSavePost(scene):
+	# sam eksport robi timer WatchHabanero, żeby nie zmieniać bpy.data w trakcie zapisu
+	if watch_state is not None:
+		watch_state.pending = True
+
+def startWatching(filename, toTMF, options):
+	global watch_state
+	watch_state = WatchState(filename, toTMF, options)
+	watch_state.export() # pierwszy, pełny eksport rozgrzewa cache
+	bpy.app.handlers.scene_update_post.append(watchSceneUpdate)
+	bpy.app.handlers.save_post.append(watchSavePost)
+
+def stopWatching():
+	global watch_state
+	watch_state = None
+	if watchSceneUpdate in bpy.app.handlers.scene_update_post:
+		bpy.app.handlers.scene_update_post.remove(watchSceneUpdate)
+	if watchSavePost in bpy.app.handlers.save_post:
+		bpy.app.handlers.save_post.remove(watchSavePost)
+
+class HabaneroExportSettings:
+	"""
+		Właściwości wspólne dla eksportu i trybu obserwowania.
+	"""
 	filepath = bpy.props.StringProperty(
 			name="File Path",
 			description="Filepath used for exporting the SAF file",
@@ -841,12 +1815,73 @@ class ExportToHabanero(bpy.types.Operator):
 		default = False
 	)
 
+	vertexStreams = bpy.props.BoolProperty(
+		name="Vertex streams",
+		description="Write a vertex format descriptor and separate attribute streams (SMF3/TMF3)",
+		default = False
+	)
+
+	exportTangents = bpy.props.BoolProperty(
+		name="Tangents",
+		description="Compute per-vertex tangents and write them as a vertex stream (implies vertex streams)",
+		default = False
+	)
+
+	compressIndices = bpy.props.BoolProperty(
+		name="Compress indices",
+		description="Encode sub-mesh index buffers with the index codec (implies vertex streams)",
+		default = False
+	)
+
+	batchCellSize = bpy.props.FloatProperty(
+		name="Batch cell size",
+		description="Split TMF geometry into per-material batches on a grid of this cell size (0 = no batching, implies vertex streams)",
+		min = 0.,
+		default = 0.
+	)
+
+	binaryNameIndex = bpy.props.BoolProperty(
+		name="Binary i2n",
+		description="Write i2n.bin with hashed name lookup instead of the text i2n",
+		default = False
+	)
+
+	animationWorkers = bpy.props.IntProperty(
+		name="Animation workers",
+		description="Number of background Blender processes sampling actions in parallel (0 = sample here)",
+		min = 0,
+		default = 0
+	)
+
+	def get_options(self):
+		options = ExportOptions()
+		options.tangents = self.exportTangents
+		options.compress_indices = self.compressIndices
+		options.animation_workers = self.animationWorkers
+		options.binary_i2n = self.binaryNameIndex
+		if self.saveToTMF:
+			options.batch_cell_size = self.batchCellSize
+		options.vertex_streams = self.vertexStreams or self.exportTangents or self.compressIndices or \
+								 options.batch_cell_size > 0.
+		return options
+
+class ExportToHabanero(bpy.types.Operator, HabaneroExportSettings):
+	"""Export Skeleton Mesh / Skeletal Animation file(s)"""
+	global exportMessage
+	bl_idname = "export_mesh.hab"
+	bl_label = "Export SMF/SAF"
+	__doc__ = """Select one mesh to be exported."""
+
 	@classmethod
 	def poll(cls, context):
 		return True
 
 	def execute(self, context):
-		writeFiles(self.filepath, self.saveToTMF)
+		try:
+			writeFiles(self.filepath, self.saveToTMF, self.get_options())
+		except IOError as e:
+			self.report({'ERROR'}, str(e))
+			return {'CANCELLED'}
 		self.report({'WARNING', 'INFO'}, exportMessage)
 		return {'FINISHED'}
 	
@@ -855,15 +1890,91 @@ class ExportToHabanero(bpy.types.Operator):
 		wm.fileselect_add(self)
 		return {'RUNNING_MODAL'}
 
+class WatchHabanero(bpy.types.Operator, HabaneroExportSettings):
+	"""Re-export SMF/SAF file(s) every time the .blend is saved"""
+	bl_idname = "export_mesh.hab_watch"
+	bl_label = "Watch SMF/SAF"
+	__doc__ = """Toggle automatic re-export on save."""
+
+	@classmethod
+	def poll(cls, context):
+		return True
+
+	def execute(self, context):
+		if watch_state is not None:
+			stopWatching()
+			self.report({'INFO'}, "Stopped watching")
+			return {'FINISHED'}
+		startWatching(self.filepath, self.saveToTMF, self.get_options())
+		self.report({'INFO'}, "Watching, re-exporting to %s on save" % self.filepath)
+		self.state = watch_state
+		wm = context.window_manager
+		self.timer = wm.event_timer_add(0.5, context.window)
+		wm.modal_handler_add(self)
+		return {'RUNNING_MODAL'}
+
+	def modal(self, context, event):
+		if watch_state is not self.state: # wyłączone drugim wywołaniem operatora
+			context.window_manager.event_timer_remove(self.timer)
+			return {'CANCELLED'}
+		if event.type == 'TIMER' and watch_state.pending:
+			watch_state.export()
+		return {'PASS_THROUGH'}
+
+	def invoke(self, context, event):
+		if watch_state is not None:
+			return self.execute(context)
+		wm = context.window_manager
+		wm.fileselect_add(self)
+		return {'RUNNING_MODAL'}
+
+class SampleHabaneroActions(bpy.types.Operator):
+	"""Sample a subset of actions into a partial animation file (used by animation workers)"""
+	bl_idname = "export_anim.hab_actions"
+	bl_label = "Sample SAF actions"
+
+	jobpath = bpy.props.StringProperty(
+			name="Job Path",
+			description="JSON file describing the armature, joints and actions to sample",
+			maxlen= 1024,
+			subtype='FILE_PATH'
+			)
+
+	def execute(self, context):
+		file = open(self.jobpath, "r")
+		job = json.load(file)
+		file.close()
+		armature_obj = bpy.data.objects[job["armature"]]
+		joint_ids = {}
+		for i in range(len(job["joints"])):
+			joint_ids[job["joints"][i]] = i
+		rest_inverted, frame_length = prepareSampling(armature_obj)
+		animations = []
+		for name in job["actions"]:
+			animations.append(sampleAction(armature_obj, bpy.data.actions[name], joint_ids,
+										   len(job["joints"]), rest_inverted, frame_length))
+		temporary = job["output"] + ".tmp"
+		file = open(temporary, "wb")
+		file.write(dumpPartialAnimations(animations, joint_ids))
+		file.close()
+		replaceFile(temporary, job["output"])
+		return {'FINISHED'}
+
 def menu_func(self, context):
 	default_path = os.path.splitext(bpy.data.filepath)[0] + ".saf"
 	self.layout.operator(ExportToHabanero.bl_idname, text="Skeleton Mesh / Skeletal Animation (.smf/.saf)").filepath = default_path
+	if watch_state is None:
+		watch_text = "Skeleton Mesh / Skeletal Animation - re-export on save"
+	else:
+		watch_text = "Skeleton Mesh / Skeletal Animation - stop re-exporting"
+	self.layout.operator(WatchHabanero.bl_idname, text=watch_text).filepath = default_path
 
 def register():
 	bpy.utils.register_module(__name__)
 	bpy.types.INFO_MT_file_export.append(menu_func)
 
 def unregister():
+	stopWatching()
 	bpy.utils.unregister_module(__name__)
 	bpy.types.INFO_MT_file_export.remove(menu_func)
 
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+"""
+	Konwerter OBJ -> TMF/SMF, MTF i i2n bez uruchamiania blendera.
+
+	Plik OBJ jest czytany strumieniowo, linia po linii. Wielokąty są
+	triangulowane wachlarzem, a wierzchołki spawane po trójce indeksów
+	(pozycja, uv, normalna). Ściany są grupowane po usemtl w sub-meshe.
+	Wierzchołki i indeksy od razu trafiają do plików tymczasowych. Surowe
+	v/vt/vn trzymamy w pamięci przez cały czas (w tablicach array), bo
+	ściany mogą się odwoływać do dowolnych wcześniejszych; ich rozmiar
+	rośnie z wejściem. Tablica spawania (WeldTable) ma stały limit
+	wpisów - po jego przekroczeniu zaczynamy spawać od nowa, więc
+	wierzchołek używany daleko od poprzedniego użycia może się powtórzyć.
+
+	Układy plików są takie same jak w io_export_habanero.py
+	(SkinnedMesh.dump_tmf, SubMesh.dump, Material.dump); i2n i manifest
+	zapisujemy tym samym kodem z habanero_formats.py.
+	Podobnie jak importer OBJ z blendera zamieniamy osie (Y w górę -> Z w górę)
+	i odwracamy współrzędną v tekstury, tak jak robi to eksporter.
+"""
+
+import os
+import sys
+import tempfile
+import zlib
+
+from array import array
+from struct import pack, unpack
+
+from habanero_formats import replaceFile, dumpManifest, dumpBinaryI2n, dumpTextI2n, Color, dumpMaterial
+
+maxChunkIndices = 1 << 20 # tyle indeksów sub-mesha trzymamy w pamięci, zanim zrzucimy je na dysk
+copyChunkSize = 1 << 20
+maxWeldedVertices = 1 << 20 # tyle spawanych wierzchołków pamiętamy naraz (ok. 75 MB tablicy)
+
+class Material:
+	"""
+		Odpowiednik Material z eksportera: values[i] to kolor/liczba albo
+		numer tekstury (int, numerowane od 1).
+	"""
+	def __init__(self, name):
+		self.id = 0
+		self.name = name
+		self.values = [None] * 32
+		self.values[0] = Color([1., 1., 1.])
+		self.values[1] = Color([0.8, 0.8, 0.8])
+		self.values[2] = Color([1., 1., 1.])
+		self.values[3] = Color([0., 0., 0.])
+		self.values[4] = 1.
+
+	def dump(self):
+		return dumpMaterial(self.values)
+
+# słowo kluczowe MTL -> indeks w Material.values (tak jak w Material.set)
+textureSlots = {
+	"map_ka": 0,
+	"map_kd": 1,
+	"map_ks": 2,
+	"map_d": 4,
+	"map_bump": 5,
+	"bump": 5,
+	"map_disp": 6,
+	"disp": 6,
+}
+
+colorSlots = {
+	"ka": 0,
+	"kd": 1,
+	"ks": 2,
+	"ke": 3,
+}
+
+class MaterialLibrary:
+	def __init__(self):
+		self.materials = {} # nazwa -> słownik słowo kluczowe -> wartość
+		self.textures = [] # numerowane od 1, jak w eksporterze
+
+	def load(self, filename):
+		if not os.path.isfile(filename):
+			print("Material library %s not found." % filename)
+			return
+		current = None
+		file = open(filename, "r")
+		for line in file:
+			fields = line.split(None, 1)
+			if len(fields) < 2 or fields[0].startswith("#"):
+				continue
+			keyword = fields[0].lower()
+			value = fields[1].strip()
+			if keyword == "newmtl":
+				current = {}
+				self.materials[value] = current
+			elif current is not None:
+				current[keyword] = value
+		file.close()
+
+	def texture_id(self, filename):
+		if filename[0:2] == '//':
+			filename = filename[2:]
+		if filename not in self.textures:
+			self.textures.append(filename)
+		return self.textures.index(filename) + 1
+
+	def create(self, name):
+		material = Material(name)
+		properties = self.materials.get(name, {})
+		for keyword, slot in colorSlots.items():
+			if keyword in properties:
+				material.values[slot] = Color([float(x) for x in properties[keyword].split()[:3]])
+		if "d" in properties:
+			material.values[4] = float(properties["d"].split()[0])
+		elif "tr" in properties:
+			material.values[4] = 1. - float(properties["tr"].split()[0])
+		for keyword, slot in sorted(textureSlots.items()):
+			if keyword in properties:
+				# opcje (-bm 1 itp.) są przed nazwą pliku, bierzemy ostatnie słowo
+				material.values[slot] = self.texture_id(properties[keyword].split()[-1])
+		return material
+
+class SubMesh:
+	"""
+		Indeksy jednego materiału; gdy jest ich dużo, zrzucamy je do pliku
+		tymczasowego.
+	"""
+	def __init__(self, material):
+		self.material = material
+		self.indices = array('I')
+		self.spill = None
+		self.count = 0
+
+	def append(self, index):
+		self.indices.append(index)
+		self.count += 1
+		if len(self.indices) >= maxChunkIndices:
+			self.flush()
+
+	def flush(self):
+		if self.spill is None:
+			self.spill = tempfile.TemporaryFile()
+		self.indices.tofile(self.spill)
+		self.indices = array('I')
+
+	def chunks(self):
+		yield pack('II', self.material.id, self.count)
+		if self.spill is not None:
+			self.flush()
+			self.spill.seek(0)
+			while True:
+				chunk = self.spill.read(copyChunkSize)
+				if not chunk:
+					break
+				yield chunk
+			self.spill.close()
+		else:
+			yield self.indices.tobytes()
+
+class BoundingVolume:
+	def __init__(self):
+		self.min = [float("inf")] * 3
+		self.max = [float("-inf")] * 3
+
+	def update(self, position):
+		for i in range(3):
+			if position[i] < self.min[i]:
+				self.min[i] = position[i]
+			if position[i] > self.max[i]:
+				self.max[i] = position[i]
+
+	def dump(self):
+		return pack('B', 1) + pack('ffffff', *(self.min + self.max))
+
+class WeldTable:
+	"""
+		Tablica z adresowaniem otwartym (próbkowanie liniowe) na tablicach
+		array: klucz to 4 liczby int64, wartość to indeks wierzchołka
+		(-1 w pustym miejscu). Zajmuje 36 bajtów na miejsce zamiast
+		słownika krotek.
+	"""
+	width = 4
+
+	def __init__(self, capacity = 1 << 12):
+		self.allocate(capacity)
+
+	def allocate(self, capacity):
+		self.capacity = capacity
+		self.count = 0
+		self.keys = array('q', [0]) * (capacity * self.width)
+		self.values = array('i', [-1]) * capacity
+
+	def slot(self, key):
+		mask = self.capacity - 1
+		i = hash(key) & mask
+		while True:
+			if self.values[i] < 0:
+				return i
+			base = i * self.width
+			if tuple(self.keys[base:base + self.width]) == key:
+				return i
+			i = (i + 1) & mask
+
+	def get(self, key):
+		value = self.values[self.slot(key)]
+		if value < 0:
+			return None
+		return value
+
+	def put(self, key, value):
+		if 2 * (self.count + 1) > self.capacity:
+			self.grow()
+		i = self.slot(key)
+		if self.values[i] < 0:
+			self.count += 1
+		self.keys[i * self.width:(i + 1) * self.width] = array('q', key)
+		self.values[i] = value
+
+	def grow(self):
+		keys = self.keys
+		values = self.values
+		self.allocate(2 * self.capacity)
+		for i in range(len(values)):
+			if values[i] >= 0:
+				self.put(tuple(keys[i * self.width:(i + 1) * self.width]), values[i])
+
+	def clear(self):
+		self.allocate(1 << 12)
+
+def weldKey(corner, face_normal):
+	"""
+		Klucz spawania: indeksy pozycji, uv i normalnej, a dla rogów bez
+		normalnej jeszcze bity normalnej ściany (jako float32, tak jak
+		trafia do pliku).
+	"""
+	position_index, tex_index, normal_index = corner
+	indices = ((tex_index + 1) << 32) | (normal_index + 1)
+	if normal_index >= 0:
+		return (position_index, indices, 0, 0)
+	x, y, z = unpack('iii', pack('fff', face_normal[0], face_normal[1], face_normal[2]))
+	return (position_index, indices, (x & 0xFFFFFFFF) | (y << 32), z)
+
+def parseIndex(token, count):
+	"""Indeks OBJ (od 1, ujemne od końca) -> indeks od 0, -1 gdy brak."""
+	if token == "":
+		return -1
+	index = int(token)
+	if index < 0:
+		return count + index
+	return index - 1
+
+class ObjConverter:
+	def __init__(self, smf = False, convert_axes = True, binary_i2n = False):
+		self.smf = smf
+		self.convert_axes = convert_axes
+		self.binary_i2n = binary_i2n
+		self.positions = array('f')
+		self.tex_coords = array('f')
+		self.normals = array('f')
+		self.library = MaterialLibrary()
+		self.sub_meshes = [] # w kolejności pierwszego użycia materiału
+		self.by_name = {}
+		self.current = None
+		self.welded = WeldTable() # weldKey -> indeks wierzchołka
+		self.vertex_count = 0
+		self.vertices = tempfile.TemporaryFile()
+		self.vertex_buffer = []
+		self.bb = BoundingVolume()
+
+	def axes(self, x, y, z):
+		if self.convert_axes:
+			return x, -z, y
+		return x, y, z
+
+	def use_material(self, name):
+		if name not in self.by_name:
+			material = self.library.create(name)
+			material.id = len(self.sub_meshes) + 1 # 0 to zaślepka, jak w eksporterze
+			sub_mesh = SubMesh(material)
+			self.sub_meshes.append(sub_mesh)
+			self.by_name[name] = sub_mesh
+		self.current = self.by_name[name]
+
+	def vertex(self, corner, face_normal):
+		key = weldKey(corner, face_normal)
+		index = self.welded.get(key)
+		if index is not None:
+			return index
+		position_index, tex_index, normal_index = corner
+		position = self.positions[3 * position_index:3 * position_index + 3]
+		if normal_index >= 0:
+			normal = self.normals[3 * normal_index:3 * normal_index + 3]
+		else:
+			normal = face_normal
+		tex = (0., 0.)
+		if tex_index >= 0:
+			tex = (self.tex_coords[2 * tex_index], 1.0 - self.tex_coords[2 * tex_index + 1]) # taka przypadłość blendera
+		self.bb.update(position)
+		data = pack('ffffffff', position[0], position[1], position[2], normal[0], normal[1], normal[2], tex[0], tex[1])
+		if self.smf: # brak kości: 4 puste jointy z wagą 0
+			data += pack('IIIIffff', 0, 0, 0, 0, 0., 0., 0., 0.)
+		self.vertex_buffer.append(data)
+		if len(self.vertex_buffer) >= 4096:
+			self.vertices.write(b"".join(self.vertex_buffer))
+			self.vertex_buffer = []
+		index = self.vertex_count
+		if self.welded.count >= maxWeldedVertices:
+			self.welded.clear()
+		self.welded.put(key, index)
+		self.vertex_count += 1
+		return index
+
+	def face_normal(self, corners):
+		p = [self.positions[3 * c[0]:3 * c[0] + 3] for c in corners[:3]]
+		a = [p[1][i] - p[0][i] for i in range(3)]
+		b = [p[2][i] - p[0][i] for i in range(3)]
+		n = [a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]]
+		length = (n[0] * n[0] + n[1] * n[1] + n[2] * n[2]) ** 0.5
+		if length < 1e-12:
+			return (0., 0., 1.)
+		return (n[0] / length, n[1] / length, n[2] / length)
+
+	def face(self, tokens):
+		position_count = len(self.positions) // 3
+		tex_count = len(self.tex_coords) // 2
+		normal_count = len(self.normals) // 3
+		corners = []
+		for token in tokens:
+			parts = token.split("/") + ["", ""]
+			corners.append((parseIndex(parts[0], position_count),
+							parseIndex(parts[1], tex_count),
+							parseIndex(parts[2], normal_count)))
+		if len(corners) < 3:
+			return
+		if self.current is None:
+			self.use_material("default")
+		face_normal = None
+		if any(c[2] < 0 for c in corners):
+			face_normal = self.face_normal(corners)
+		indices = []
+		for corner in corners: # bez normalnej: spawamy tylko w obrębie tej samej normalnej ściany
+			indices.append(self.vertex(corner, face_normal))
+		for i in range(1, len(indices) - 1): # triangulacja wachlarzem
+			self.current.append(indices[0])
+			self.current.append(indices[i])
+			self.current.append(indices[i + 1])
+
+	def read(self, filename):
+		print("Reading %s" % filename)
+		directory = os.path.dirname(filename)
+		file = open(filename, "r")
+		for line in file:
+			fields = line.split()
+			if not fields:
+				continue
+			keyword = fields[0]
+			if keyword == "v":
+				self.positions.extend(self.axes(float(fields[1]), float(fields[2]), float(fields[3])))
+			elif keyword == "vt":
+				self.tex_coords.extend((float(fields[1]), float(fields[2]) if len(fields) > 2 else 0.))
+			elif keyword == "vn":
+				self.normals.extend(self.axes(float(fields[1]), float(fields[2]), float(fields[3])))
+			elif keyword == "f":
+				self.face(fields[1:])
+			elif keyword == "usemtl":
+				self.use_material(line.split(None, 1)[1].strip())
+			elif keyword == "mtllib": # może być kilka bibliotek w jednej linii
+				for library in fields[1:]:
+					self.library.load(os.path.join(directory, library))
+		file.close()
+		if self.vertex_buffer:
+			self.vertices.write(b"".join(self.vertex_buffer))
+			self.vertex_buffer = []
+		print("Read %d vertices, %d submeshes" % (self.vertex_count, len(self.sub_meshes)))
+
+	def mesh_chunks(self):
+		if self.smf:
+			yield pack('BBBBI', ord('S'), ord('M'), ord('F'), ord('2'), 1)
+		else:
+			yield pack('BBBB', ord('T'), ord('M'), ord('F'), ord('2'))
+		yield pack('II', self.vertex_count, len(self.sub_meshes))
+		self.vertices.seek(0)
+		while True:
+			chunk = self.vertices.read(copyChunkSize)
+			if not chunk:
+				break
+			yield chunk
+		for sub_mesh in self.sub_meshes:
+			for chunk in sub_mesh.chunks():
+				yield chunk
+		yield self.bb.dump()
+
+	def i2n_chunks(self):
+		sections = [("materials", [(sub_mesh.material.id, sub_mesh.material.name) for sub_mesh in self.sub_meshes]),
+					("textures", [(i + 1, self.library.textures[i]) for i in range(len(self.library.textures))])]
+		if self.binary_i2n:
+			yield dumpBinaryI2n(sections)
+		else:
+			yield dumpTextI2n(sections)
+
+	def write(self, file_path):
+		"""
+			Każdy plik zapisujemy do pliku tymczasowego i przenosimy na
+			miejsce; na koniec manifest z crc32, jak w eksporterze.
+		"""
+		directory = os.path.dirname(file_path)
+		extension = ".smf" if self.smf else ".tmf"
+		outputs = [(os.path.splitext(file_path)[0] + extension, self.mesh_chunks())]
+		for sub_mesh in self.sub_meshes:
+			material = sub_mesh.material
+			data = pack('BBBB', ord('M'), ord('T'), ord('F'), ord('2')) + material.dump()
+			outputs.append((os.path.join(directory, material.name + ".mtf"), iter([data])))
+		outputs.append((os.path.join(directory, "i2n.bin" if self.binary_i2n else "i2n"), self.i2n_chunks()))
+
+		manifest_path = os.path.splitext(file_path)[0] + ".manifest"
+		if os.path.isfile(manifest_path):
+			os.remove(manifest_path)
+		entries = {}
+		for filename, chunks in outputs:
+			entries[os.path.relpath(filename, directory or ".")] = writeChunks(filename, chunks)
+		writeChunks(manifest_path, iter([dumpManifest(entries)]))
+
+def writeChunks(filename, chunks):
+	temporary = filename + ".tmp"
+	crc = 0
+	size = 0
+	file = open(temporary, "wb")
+	try:
+		for chunk in chunks:
+			file.write(chunk)
+			crc = zlib.crc32(chunk, crc)
+			size += len(chunk)
+		file.flush()
+		os.fsync(file.fileno())
+	finally:
+		file.close()
+	replaceFile(temporary, filename)
+	return crc & 0xFFFFFFFF, size
+
+def main(argv):
+	if len(argv) < 2:
+		print("Usage: obj2tmf.py input.obj output.tmf [-smf] [-noaxes] [-binaryi2n]")
+		return 1
+	converter = ObjConverter(smf = "-smf" in argv[2:], convert_axes = "-noaxes" not in argv[2:],
+							 binary_i2n = "-binaryi2n" in argv[2:])
+	converter.read(argv[0])
+	converter.write(argv[1])
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
\ No newline at end of file